@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Benchmark of logclean collect_files showing scan time grows linearly with file count"""
+
+import os
+import sys
+import re
+import time
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from tplogtools.logcleanlib import collect_files # pylint: disable=wrong-import-position
+
+def group_name(index):
+    """Return letters naming group of given index, the group regex ends at the first digit"""
+    letters = ''
+    while True:
+        index, rest = divmod(index, 26)
+        letters = chr(ord('a') + rest) + letters
+        if not index:
+            return letters
+        index -= 1
+
+def make_tree(path, files, groups):
+    """Create given amount of empty files spread over groups"""
+    for i in range(files):
+        open(os.path.join(path, 'group{}_-{}.log'.format(group_name(i % groups), i)), 'wb').close()
+
+def measure(files, groups, recursive):
+    """Return seconds spent in collect_files over fresh directory"""
+    with tempfile.TemporaryDirectory() as sandbox:
+        make_tree(sandbox, files, groups)
+        r_group = re.compile('(?P<group>[^0-9]+)[0-9][^/]*')
+        start = time.perf_counter()
+        collect_files([sandbox], r_group, 0, time.time(), recursive)
+        return time.perf_counter() - start
+
+def main():
+    """Run scan over growing trees and print time per file"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--files', type=int, default=25000, help='Files in the smallest tree')
+    parser.add_argument('-g', '--groups', type=int, default=1000, help='Number of file groups')
+    parser.add_argument('-s', '--steps', type=int, default=4, help='How many times the tree is doubled')
+    parser.add_argument('-r', '--recursive', action='store_true', help='Use recursive scan')
+    args = parser.parse_args()
+    base = None
+    for step in range(args.steps):
+        files = args.files * 2 ** step
+        seconds = measure(files, args.groups, args.recursive)
+        per_file = seconds / files
+        base = base or per_file
+        print('{:>10d} files {:8.3f} s {:10.0f} files/s {:6.2f}x time per file'.format(files, seconds, files / seconds, per_file / base))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+"""Throughput and latency benchmarks of logtime, stdout2log, logrot and logclean with JSON results comparable to a baseline"""
+
+import os
+import sys
+import re
+import io
+import json
+import time
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+# pylint: disable=wrong-import-position
+from tplogtools.logcleanlib import collect_files, remove_device_files
+from tplogtools.logrotlib import process_paths
+from tplogtools.timetools import local_tz_now
+from tplogtools.metrics import RunMetrics
+
+PIPE_TOOLS = {
+    'logtime': ['logtime'],
+    'logtime_chunked': ['logtime', '-r', '65536', '-b', '65536', '-i', '10'],
+    'stdout2log': ['stdout2log', '-t', '00:00', '-b', 'backup-%Y%m%d.log', 'live.log'],
+    'stdout2log_buffered': ['stdout2log', '-t', '00:00', '-b', 'backup-%Y%m%d.log', '-B', '256', '-d', '10', 'live.log'],
+}
+
+def make_lines(count, size):
+    """Yield synthetic lines of given size starting by the time of their creation"""
+    filler = b'x' * size
+    for _ in range(count):
+        stamp = b'%d ' % time.perf_counter_ns()
+        yield stamp + filler[:max(0, size - len(stamp) - 1)] + b'\n'
+
+def feed(output, count, size, rate):
+    """Write lines to output at given rate per second, as fast as possible without rate"""
+    start = time.perf_counter()
+    batch = max(1, rate // 1000) if rate else 1000
+    sent = 0
+    while sent < count:
+        amount = min(batch, count - sent)
+        output.write(b''.join(make_lines(amount, size)))
+        output.flush()
+        sent += amount
+        if rate:
+            delay = start + sent / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    output.close()
+
+def collect_latencies(stream, count, latencies, file_mode=False):
+    """Read lines from stream and store delay since their creation, a file is polled until all lines come"""
+    partial = b''
+    received = 0
+    while received < count:
+        data = stream.read1(65536) if not file_mode else stream.read(65536)
+        now = time.perf_counter_ns()
+        if not data:
+            if not file_mode:
+                break
+            time.sleep(0.0005)
+            continue
+        lines = (partial + data).split(b'\n')
+        partial = lines.pop()
+        for line in lines:
+            fields = line.split(b' ')
+            # logtime puts its timestamp before the line
+            stamp = fields[0] if fields[0].isdigit() else fields[1]
+            latencies.append((now - int(stamp)) / 1000000)
+        received += len(lines)
+
+def percentile(values, share):
+    """Return value under which given share of sorted values lies"""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+def bench_pipe(name, count, size, rate):
+    """Run pipe tool over synthetic lines and return lines/s and per-line latency"""
+    argv = [sys.executable, os.path.join(ROOT, PIPE_TOOLS[name][0])] + PIPE_TOOLS[name][1:]
+    latencies = []
+    with tempfile.TemporaryDirectory() as sandbox:
+        to_file = PIPE_TOOLS[name][0] == 'stdout2log'
+        proc = subprocess.Popen(argv, stdin=subprocess.PIPE, stdout=None if to_file else subprocess.PIPE, cwd=sandbox)
+        start = time.perf_counter()
+        feeder = threading.Thread(target=feed, args=(proc.stdin, count, size, rate))
+        feeder.start()
+        if to_file:
+            while not os.path.exists(os.path.join(sandbox, 'live.log')):
+                time.sleep(0.001)
+            with open(os.path.join(sandbox, 'live.log'), 'rb') as live:
+                collect_latencies(live, count, latencies, True)
+        else:
+            collect_latencies(proc.stdout, count, latencies)
+        seconds = time.perf_counter() - start
+        feeder.join()
+        proc.wait()
+    latencies.sort()
+    return {
+        'lines': len(latencies),
+        'lines_per_s': len(latencies) / seconds,
+        'latency_p50_ms': percentile(latencies, 0.5),
+        'latency_p99_ms': percentile(latencies, 0.99),
+    }
+
+def group_name(index):
+    """Return letters naming group of given index, the group regex ends at the first digit"""
+    letters = ''
+    while True:
+        index, rest = divmod(index, 26)
+        letters = chr(ord('a') + rest) + letters
+        if not index:
+            return letters
+        index -= 1
+
+def make_tree(path, files, groups, old_share=0.5):
+    """Create files spread over groups, given share of them is older than 30 days"""
+    old = time.time() - 30 * 86400
+    for i in range(files):
+        filename = os.path.join(path, 'group{}_-{}.log'.format(group_name(i % groups), i))
+        with open(filename, 'wb') as output:
+            output.write(b'line\n')
+        if i < files * old_share:
+            os.utime(filename, (old, old))
+
+def bench_logclean(files, groups, jobs):
+    """Return files/s of scan, plan and delete stages of logclean"""
+    with tempfile.TemporaryDirectory() as sandbox:
+        make_tree(sandbox, files, groups)
+        r_group = re.compile('(?P<group>[^0-9]+)[0-9][^/]*')
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            devices = collect_files([sandbox], r_group, 0, time.time())
+            scanned = time.perf_counter()
+            plans = [(device, device.get_files_to_remove(0, 0, 10)) for device in devices.values()]
+            planned = time.perf_counter()
+            for device, to_remove in plans:
+                remove_device_files(device, to_remove, jobs)
+            deleted = time.perf_counter()
+    removed = sum(len(to_remove) for _, to_remove in plans)
+    return {
+        'files': files,
+        'scan_files_per_s': files / (scanned - start),
+        'plan_files_per_s': files / (planned - scanned),
+        'delete_files_per_s': removed / (deleted - planned) if removed else 0.0,
+    }
+
+def bench_logrot(files, jobs):
+    """Return files/s of scan and rotation of logrot"""
+    with tempfile.TemporaryDirectory() as sandbox:
+        for i in range(files):
+            with open(os.path.join(sandbox, 'app{}.log'.format(i)), 'wb') as output:
+                output.write(b'line\n')
+        conf = {'defaults': {'target': 'backup/{{name}}-%Y%m%d%H.{{ext}}', 'interval': 'hourly'}}
+        metrics = RunMetrics('logrot')
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            process_paths(local_tz_now(), conf, 'hourly', [sandbox], jobs, metrics)
+        seconds = time.perf_counter() - start
+    scan = metrics.stages.get('scan', 0.0)
+    return {
+        'files': files,
+        'scan_files_per_s': files / scan if scan else 0.0,
+        'rotate_files_per_s': files / (seconds - scan),
+    }
+
+def higher_is_better(metric):
+    """Throughputs should grow, latencies should drop"""
+    return metric.endswith('_per_s')
+
+def best_of(runs):
+    """Return the best value of each metric over repeated runs, it is the least affected by noise"""
+    best = dict(runs[0])
+    for run in runs[1:]:
+        for metric, value in run.items():
+            if metric.endswith('_per_s'):
+                best[metric] = max(best[metric], value)
+            elif metric.endswith('_ms'):
+                best[metric] = min(best[metric], value)
+    return best
+
+def compare(results, baseline, tolerance):
+    """Print change of each metric against baseline, return list of regressions beyond tolerance"""
+    regressions = []
+    for bench, metrics in sorted(results['benchmarks'].items()):
+        for metric, value in sorted(metrics.items()):
+            old = baseline.get('benchmarks', {}).get(bench, {}).get(metric)
+            if not old or not (metric.endswith('_per_s') or metric.endswith('_ms')):
+                continue
+            change = value / old - 1
+            worse = -change if higher_is_better(metric) else change
+            flag = 'REGRESSION' if worse > tolerance else ''
+            print('{:<28s} {:<22s} {:14.2f} {:14.2f} {:+8.1%} {}'.format(bench, metric, old, value, change, flag))
+            if flag:
+                regressions.append((bench, metric))
+    return regressions
+
+def main():
+    """Run selected benchmarks, write JSON and compare it to baseline"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--output', help='Write results as JSON to file')
+    parser.add_argument('-b', '--baseline', help='Compare results to JSON file of earlier run, exit code is 1 on regression')
+    parser.add_argument('-t', '--tolerance', type=float, default=10, help='Allowed regression in percent (default: 10)')
+    parser.add_argument('-l', '--lines', type=int, default=200000, help='Lines sent through pipe tools (default: 200000)')
+    parser.add_argument('-s', '--line-size', type=int, default=120, help='Size of line in bytes (default: 120)')
+    parser.add_argument('-r', '--rate', type=int, default=0, help='Lines per second sent to pipe tools, 0 means as fast as possible')
+    parser.add_argument('--latency-lines', type=int, default=10000, help='Lines of the latency run (default: 10000)')
+    parser.add_argument('--latency-rate', type=int, default=5000, help='Lines per second of the latency run (default: 5000)')
+    parser.add_argument('-n', '--files', type=int, default=20000, help='Files in trees for logclean and logrot (default: 20000)')
+    parser.add_argument('-g', '--groups', type=int, default=500, help='File groups in the tree for logclean (default: 500)')
+    parser.add_argument('-R', '--repeat', type=int, default=3, help='Runs of each benchmark, the best result is kept (default: 3)')
+    parser.add_argument('-j', '--jobs', type=int, default=1, help='Jobs of logclean delete and logrot paths (default: 1)')
+    parser.add_argument('only', nargs='*', help='Run only benchmarks starting by given names')
+    args = parser.parse_args()
+
+    benchmarks = [('{}_throughput'.format(name), bench_pipe, (name, args.lines, args.line_size, args.rate)) for name in PIPE_TOOLS]
+    benchmarks += [('{}_latency'.format(name), bench_pipe, (name, args.latency_lines, args.line_size, args.latency_rate)) for name in PIPE_TOOLS]
+    benchmarks += [('logclean', bench_logclean, (args.files, args.groups, args.jobs)), ('logrot', bench_logrot, (args.files, args.jobs))]
+    results = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cpus': os.cpu_count(),
+        'started': time.time(),
+        'params': vars(args),
+        'benchmarks': {},
+    }
+    for name, function, params in benchmarks:
+        if args.only and not any(name.startswith(prefix) for prefix in args.only):
+            continue
+        print('{}...'.format(name), end=' ', flush=True, file=sys.stderr)
+        results['benchmarks'][name] = best_of([function(*params) for _ in range(max(1, args.repeat))])
+        print(', '.join('{} {:.2f}'.format(key, value) for key, value in sorted(results['benchmarks'][name].items())), file=sys.stderr)
+    content = json.dumps(results, indent=2, sort_keys=True) + '\n'
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(content)
+    else:
+        print(content, end='')
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if compare(results, baseline, args.tolerance / 100):
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
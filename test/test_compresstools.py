@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Unit-tests for compresstools"""
+
+import unittest
+import os
+import bz2
+import gzip
+import lzma
+import tempfile
+from pathlib import Path
+from tplogtools.compresstools import parse_builtin, compress_file, is_builtin
+
+class TestCompresstools(unittest.TestCase):
+    """Main test class"""
+
+    def test_parse_builtin(self):
+        """Test parsing of builtin compressor specification"""
+        self.assertTrue(is_builtin('builtin:gzip'))
+        self.assertFalse(is_builtin('gzip -9'))
+        self.assertEqual(parse_builtin('builtin:gzip:9:2'), ('gzip', 9, 2))
+        self.assertEqual(parse_builtin('builtin:xz:1:1'), ('xz', 1, 1))
+        self.assertEqual(parse_builtin('builtin:bzip2')[:2], ('bzip2', 9))
+        self.assertRaisesRegex(ValueError, 'Bad builtin compressor "builtin:zip"', parse_builtin, 'builtin:zip')
+        self.assertRaisesRegex(ValueError, 'Bad level or threads', parse_builtin, 'builtin:gzip:x')
+        self.assertRaisesRegex(ValueError, 'Bad level or threads', parse_builtin, 'builtin:gzip:6:0')
+        self.assertRaisesRegex(ValueError, 'Bad level or threads', parse_builtin, 'builtin:bzip2:0')
+        self.assertEqual(parse_builtin('builtin:gzip:0:1'), ('gzip', 0, 1))
+
+    def test_compress_file(self):
+        """Test compressed blocks form one standard stream"""
+        data = b''.join(b'line %d of the log\n' % i for i in range(20000))
+        for fmt, extension, decompress in (('gzip', '.gz', gzip.decompress), ('bz2', '.bz2', bz2.decompress), ('xz', '.xz', lzma.decompress)):
+            with tempfile.TemporaryDirectory() as sandbox:
+                source = Path(sandbox, 'app.log')
+                source.write_bytes(data)
+                os.utime(str(source), (1000000, 1000000))
+                target = compress_file(str(source), fmt, 1, 3, block_size=64 * 1024)
+                self.assertEqual(target, str(source) + extension)
+                self.assertFalse(source.exists())
+                self.assertEqual(decompress(Path(target).read_bytes()), data)
+                self.assertEqual(os.stat(target).st_mtime, 1000000)
+
+    def test_compress_file_target_exists(self):
+        """Test existing target is never overwritten"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'app.log')
+            source.write_bytes(b'data')
+            Path(sandbox, 'app.log.gz').write_bytes(b'old')
+            self.assertRaises(FileExistsError, compress_file, str(source), 'gzip', 6, 1)
+            self.assertTrue(source.exists())
+            self.assertEqual(Path(sandbox, 'app.log.gz').read_bytes(), b'old')
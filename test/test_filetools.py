@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Unit-tests for filetools"""
+
+import unittest
+from unittest import mock
+import os
+import errno
+import gzip
+import tempfile
+from pathlib import Path
+from tplogtools.filetools import move_file, copy_fd, copy_truncate
+
+def exdev_rename(source, target):
+    """Simulate rename between filesystems"""
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), source, None, target)
+
+class TestFiletools(unittest.TestCase):
+    """Main test class"""
+
+    def test_move_file_rename(self):
+        """Test move on the same filesystem"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'a.log').write_bytes(b'data')
+            self.assertEqual(move_file(str(Path(sandbox, 'a.log')), str(Path(sandbox, 'b.log'))), str(Path(sandbox, 'b.log')))
+            self.assertEqual(os.listdir(sandbox), ['b.log'])
+
+    def test_move_file_cross_device(self):
+        """Test move by copy when rename fails with EXDEV"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'a.log')
+            source.write_bytes(b'x' * 100000)
+            os.chmod(str(source), 0o640)
+            os.utime(str(source), (1000000, 1000000))
+            with mock.patch('os.rename', new=exdev_rename):
+                target = move_file(str(source), str(Path(sandbox, 'b.log')))
+            self.assertFalse(source.exists())
+            self.assertEqual(Path(target).read_bytes(), b'x' * 100000)
+            self.assertEqual(os.stat(target).st_mtime, 1000000)
+            self.assertEqual(os.stat(target).st_mode & 0o777, 0o640)
+
+    def test_move_file_cross_device_compressed(self):
+        """Test move compressing on the fly"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'a.log')
+            source.write_bytes(b'line\n' * 10000)
+            with mock.patch('os.rename', new=exdev_rename):
+                target = move_file(str(source), str(Path(sandbox, 'b.log')), ('gzip', 6, 2))
+            self.assertEqual(target, str(Path(sandbox, 'b.log.gz')))
+            self.assertFalse(source.exists())
+            self.assertEqual(gzip.decompress(Path(target).read_bytes()), b'line\n' * 10000)
+
+    def test_move_file_cross_device_target_exists(self):
+        """Test existing target is kept together with the source"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'a.log')
+            source.write_bytes(b'new')
+            Path(sandbox, 'b.log').write_bytes(b'old')
+            with mock.patch('os.rename', new=exdev_rename):
+                self.assertRaises(FileExistsError, move_file, str(source), str(Path(sandbox, 'b.log')))
+            self.assertEqual(source.read_bytes(), b'new')
+            self.assertEqual(Path(sandbox, 'b.log').read_bytes(), b'old')
+
+    def test_move_file_cross_device_short_copy(self):
+        """Test source is kept when the kernel copy ends before the end of file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'a.log')
+            source.write_bytes(b'x' * 100000)
+            with mock.patch('os.rename', new=exdev_rename), mock.patch('tplogtools.filetools.copy_fd', return_value=0):
+                self.assertRaisesRegex(OSError, 'Copied 0 of 100000 bytes', move_file, str(source), str(Path(sandbox, 'b.log')))
+            self.assertEqual(os.listdir(sandbox), ['a.log'])
+            partial = iter([40000, 60000])
+            copy_fd_orig = copy_fd
+            def short_copy(src_fd, dst_fd, size=None, offset=0):
+                return copy_fd_orig(src_fd, dst_fd, next(partial), offset)
+            with mock.patch('os.rename', new=exdev_rename), mock.patch('tplogtools.filetools.copy_fd', new=short_copy):
+                target = move_file(str(source), str(Path(sandbox, 'b.log')))
+            self.assertFalse(source.exists())
+            self.assertEqual(Path(target).read_bytes(), b'x' * 100000)
+
+    def test_copy_fd_fallbacks(self):
+        """Test copy without copy_file_range and without sendfile"""
+        def unsupported(*args):
+            raise OSError(errno.ENOSYS, os.strerror(errno.ENOSYS))
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'a.log').write_bytes(b'0123456789' * 1000)
+            for patches in (['os.copy_file_range'], ['os.copy_file_range', 'os.sendfile']):
+                with open(str(Path(sandbox, 'a.log')), 'rb') as src, open(str(Path(sandbox, 'b.log')), 'wb') as dst:
+                    with mock.patch.multiple('os', **{name[3:]: unsupported for name in patches}):
+                        self.assertEqual(copy_fd(src.fileno(), dst.fileno(), 5005), 5005)
+                self.assertEqual(Path(sandbox, 'b.log').read_bytes(), (b'0123456789' * 1000)[:5005])
+
+    def test_copy_truncate(self):
+        """Test snapshot of live file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            source = Path(sandbox, 'a.log')
+            source.write_bytes(b'line\n' * 1000)
+            with open(str(source), 'ab') as writer:
+                stats = copy_truncate(str(source), str(Path(sandbox, 'b.log')))
+                writer.write(b'new\n')
+            self.assertEqual((stats.copied, stats.lost), (5000, 0))
+            self.assertEqual(Path(sandbox, 'b.log').read_bytes(), b'line\n' * 1000)
+            self.assertEqual(source.read_bytes(), b'new\n')
+            self.assertRaises(FileExistsError, copy_truncate, str(source), str(Path(sandbox, 'b.log')))
+            self.assertEqual(source.read_bytes(), b'new\n')
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""Unit-tests for inotify binding"""
+
+import unittest
+import struct
+import tempfile
+from pathlib import Path
+from tplogtools import inotify
+
+class TestInotify(unittest.TestCase):
+    """Main test class"""
+
+    def test_parse_events(self):
+        """Test splitting raw buffer to events"""
+        data = struct.pack('iIII', 1, inotify.IN_CREATE, 0, 8) + b'a.log\0\0\0' + struct.pack('iIII', 2, inotify.IN_Q_OVERFLOW, 0, 0)
+        self.assertEqual(inotify.parse_events(data), [(1, inotify.IN_CREATE, 0, 'a.log'), (2, inotify.IN_Q_OVERFLOW, 0, '')])
+
+    def test_watch(self):
+        """Test receiving events from watched directory"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            notifier = inotify.Inotify()
+            try:
+                wd = notifier.add_watch(sandbox, inotify.IN_CREATE | inotify.IN_DELETE)
+                Path(sandbox, 'a.log').touch()
+                Path(sandbox, 'a.log').unlink()
+                events = notifier.read_events(1)
+                self.assertEqual([(event[0], event[1], event[3]) for event in events], [
+                    (wd, inotify.IN_CREATE, 'a.log'),
+                    (wd, inotify.IN_DELETE, 'a.log')
+                ])
+                self.assertEqual(notifier.read_events(0), [])
+                self.assertRaises(FileNotFoundError, notifier.add_watch, str(Path(sandbox, 'missing')), inotify.IN_CREATE)
+            finally:
+                notifier.close()
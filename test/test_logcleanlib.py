@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+"""Unit-tests for logcleanlib"""
+
+import unittest
+from unittest import mock
+import os
+import io
+import random
+import re
+import time
+import tempfile
+from pathlib import Path
+from tplogtools.logcleanlib import GroupIndex, File, Device, collect_files, remove_files, recheck_files, ScanCache, Watcher
+
+R_GROUP = re.compile('(?P<group>[^0-9]+)[0-9][^/]*')
+
+def legacy_files_to_remove(device, min_files_per_group, min_file_age, max_file_age):
+    """Original quadratic planner used as reference"""
+    to_remove = []
+    to_free = device.to_free
+    sorted_files = sorted(device.files.values(), key=lambda x: -x.age)
+    for f in list(sorted_files):
+        if f.age > min_file_age and f.age > max_file_age and device.group_counters[f.group_id] > min_files_per_group:
+            to_remove.append(f)
+            to_free -= f.blocks
+            sorted_files.remove(f)
+    for f in sorted_files:
+        if to_free > 0 and f.age > min_file_age and device.group_counters[f.group_id] > min_files_per_group:
+            to_remove.append(f)
+            to_free -= f.blocks
+    return to_remove
+
+class TestLogcleanlib(unittest.TestCase):
+    """Main test class"""
+
+    def test_group_index(self):
+        """Test interning of group names"""
+        groups = GroupIndex()
+        self.assertEqual(groups.get_id('/a/foo-'), 0)
+        self.assertEqual(groups.get_id('/a/bar-'), 1)
+        self.assertEqual(groups.get_id('/a/foo-'), 0)
+        self.assertEqual(len(groups), 2)
+
+    def test_collect_files(self):
+        """Test collecting files from directory and from explicit file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            now = time.time()
+            for name in ('app-1.log', 'app-2.log', 'db-1.log'):
+                Path(sandbox, name).write_bytes(b'x' * 10)
+                os.utime(str(Path(sandbox, name)), (now - 86400, now - 86400))
+            Path(sandbox, 'sub').mkdir()
+            Path(sandbox, 'sub', 'app-3.log').touch()
+            devices = collect_files([sandbox], R_GROUP, 0, now)
+            self.assertEqual(len(devices), 1)
+            device = list(devices.values())[0]
+            names = sorted(f.name for f in device.files.values())
+            self.assertEqual(names, [str(Path(sandbox, name)) for name in ('app-1.log', 'app-2.log', 'db-1.log', 'sub')])
+            app = [f for f in device.files.values() if f.name.endswith('app-1.log')][0]
+            self.assertEqual(device.group_counters[app.group_id], 2)
+            self.assertEqual(app.blocks, 1)
+            self.assertAlmostEqual(app.age, 1, places=3)
+            devices = collect_files([str(Path(sandbox, 'db-1.log'))], R_GROUP, 0, now)
+            self.assertEqual([f.name for f in list(devices.values())[0].files.values()], [str(Path(sandbox, 'db-1.log'))])
+
+    def test_collect_files_recursive(self):
+        """Test recursive scan groups files per directory"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'app-1.log').touch()
+            Path(sandbox, 'sub').mkdir()
+            Path(sandbox, 'sub', 'app-2.log').touch()
+            Path(sandbox, 'sub', 'app-3.log').touch()
+            devices = collect_files([sandbox], R_GROUP, 0, time.time(), recursive=True)
+            device = list(devices.values())[0]
+            names = sorted(f.name for f in device.files.values())
+            self.assertEqual(names, [str(Path(sandbox, 'app-1.log')), str(Path(sandbox, 'sub', 'app-2.log')), str(Path(sandbox, 'sub', 'app-3.log'))])
+            self.assertEqual(sorted(device.group_counters.values()), [1, 2])
+
+    def test_get_files_to_remove(self):
+        """Test overaged files go first and space is freed from the oldest"""
+        device = Device(4096, 5)
+        for name, group_id, blocks, age in (('a1', 0, 2, 10), ('a2', 0, 2, 3), ('b1', 1, 2, 20), ('b2', 1, 2, 2), ('c1', 2, 9, 30)):
+            device.inc_group_counter(group_id)
+            device.add_file(File(name, group_id, blocks, age))
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+            to_remove = device.get_files_to_remove(1, 1, 15)
+        self.assertEqual([f.name for f in to_remove], ['b1', 'a1', 'a2'])
+        self.assertEqual(fake_stdout.getvalue(), 'Overaged file: b1\nFreeing up space: a1\nFreeing up space: a2\n')
+
+    def test_get_files_to_remove_matches_legacy(self):
+        """Test planner returns the same files in the same order as the original one"""
+        rnd = random.Random(42)
+        for _ in range(200):
+            device = Device(4096, rnd.randint(-50, 300))
+            for i in range(rnd.randint(1, 60)):
+                group_id = rnd.randint(0, 8)
+                device.inc_group_counter(group_id)
+                device.add_file(File('f{}'.format(i), group_id, rnd.randint(0, 20), rnd.choice([1, 2, 5, 10, 20, rnd.random() * 30])))
+            limits = (rnd.randint(0, 5), rnd.randint(0, 10), rnd.randint(0, 25))
+            with mock.patch('sys.stdout', new=io.StringIO()), mock.patch('sys.stderr', new=io.StringIO()):
+                to_remove = device.get_files_to_remove(*limits)
+            self.assertEqual([f.name for f in to_remove], [f.name for f in legacy_files_to_remove(device, *limits)])
+
+    def test_remove_files(self):
+        """Test removing files grouped by directories"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            files = []
+            for dirname in ('a', 'b', 'c'):
+                Path(sandbox, dirname).mkdir()
+                for i in range(3):
+                    Path(sandbox, dirname, 'f{}.log'.format(i)).touch()
+                    files.append(File(str(Path(sandbox, dirname, 'f{}.log'.format(i))), 0, 2, 1))
+            files.append(File(str(Path(sandbox, 'missing.log')), 0, 2, 1))
+            with mock.patch('sys.stderr', new=io.StringIO()) as fake_stderr:
+                removed = remove_files(files, 2)
+            self.assertEqual(removed, (9, 18))
+            self.assertEqual(sorted(os.listdir(sandbox)), ['a', 'b', 'c'])
+            self.assertEqual(os.listdir(str(Path(sandbox, 'a'))), [])
+            self.assertEqual(fake_stderr.getvalue(), "Can't delete file '{}'!\n".format(Path(sandbox, 'missing.log')))
+
+    def test_scan_cache(self):
+        """Test directory listing is served from cache until directory changes"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            logs = Path(sandbox, 'logs')
+            logs.mkdir()
+            Path(logs, 'app-1.log').write_bytes(b'x' * 10)
+            old = time.time() - 60
+            os.utime(str(logs), (old, old))
+            cache_file = str(Path(sandbox, 'cache.db'))
+            cache = ScanCache(cache_file)
+            first = collect_files([str(logs)], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+            cache = ScanCache(cache_file)
+            second = collect_files([str(logs)], R_GROUP, 0, time.time(), cache=cache)
+            self.assertEqual((cache.hits, cache.misses), (1, 0))
+            self.assertEqual(
+                [(f.name, f.blocks) for f in list(first.values())[0].files.values()],
+                [(f.name, f.blocks) for f in list(second.values())[0].files.values()]
+            )
+            Path(logs, 'app-2.log').touch()
+            os.utime(str(logs), (old + 1, old + 1))
+            third = collect_files([str(logs)], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            self.assertEqual(len(list(third.values())[0].files), 2)
+            cache = ScanCache(cache_file, rebuild=True)
+            collect_files([str(logs)], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses), (0, 1))
+
+    def test_scan_cache_restats_files(self):
+        """Test size and age of file appended in unchanged directory are read again"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'app-1.log').write_bytes(b'x')
+            old = time.time() - 60
+            os.utime(sandbox, (old, old))
+            cache = ScanCache(':memory:')
+            collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            with Path(sandbox, 'app-1.log').open('ab') as output:
+                output.write(b'x' * 100000)
+            os.utime(sandbox, (old, old))
+            devices = collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses), (1, 1))
+            device = list(devices.values())[0]
+            self.assertEqual(device.files[str(Path(sandbox, 'app-1.log'))].blocks, -(-100001 // device.block_size))
+            self.assertLess(device.files[str(Path(sandbox, 'app-1.log'))].age, 1 / 24)
+
+    def test_scan_cache_reuses_settled_stats(self):
+        """Test stats of files not modified for SETTLE_SECONDS are served from cache"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            settled = Path(sandbox, 'app-1.log')
+            settled.write_bytes(b'x')
+            old = time.time() - ScanCache.SETTLE_SECONDS - 60
+            os.utime(str(settled), (old, old))
+            Path(sandbox, 'app-2.log').write_bytes(b'x')
+            os.utime(sandbox, (old, old))
+            cache = ScanCache(':memory:')
+            collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            with settled.open('ab') as output:
+                output.write(b'x' * 100000)
+            os.utime(str(settled), (old, old))
+            os.utime(sandbox, (old, old))
+            devices = collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses, cache.restats), (1, 1, 1))
+            device = list(devices.values())[0]
+            self.assertEqual(device.files[str(settled)].blocks, 1)
+
+    def test_recheck_files(self):
+        """Test files modified or removed after they were cached are not deleted"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            now = time.time()
+            for name in ('app-1.log', 'app-2.log'):
+                Path(sandbox, name).touch()
+                os.utime(str(Path(sandbox, name)), (now - 86400, now - 86400))
+            os.utime(str(Path(sandbox, 'app-2.log')), (now, now))
+            files = [File(str(Path(sandbox, name)), 0, 1, 1) for name in ('app-1.log', 'app-2.log', 'app-3.log')]
+            with mock.patch('sys.stderr', new=io.StringIO()) as fake_stderr:
+                rechecked = recheck_files(files, now)
+            self.assertEqual([f.name for f in rechecked], [str(Path(sandbox, 'app-1.log'))])
+            self.assertIn('app-2.log', fake_stderr.getvalue())
+
+    def test_scan_cache_racy_directory(self):
+        """Test directory modified just now is not stored to cache"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'app-1.log').touch()
+            cache = ScanCache(':memory:')
+            collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            collect_files([sandbox], R_GROUP, 0, time.time(), cache=cache)
+            cache.close()
+            self.assertEqual((cache.hits, cache.misses), (0, 2))
+
+    def test_watcher(self):
+        """Test watcher removes overaged files found by scan and by inotify"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            old = time.time() - 20 * 24 * 60 * 60
+            for name in ('app-1.log', 'app-2.log'):
+                Path(sandbox, name).touch()
+            os.utime(str(Path(sandbox, 'app-1.log')), (old, old))
+            watcher = Watcher({sandbox}, R_GROUP, {
+                'dry-run': False, 'recursive': False, 'poll-interval': 1, 'delete-jobs': 1,
+                'min-files-per-group': 0, 'min-free-space-on-device': 0, 'max-file-age': 10, 'min-file-age': 0
+            })
+            try:
+                with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                    watcher.scan()
+                    watcher.poll()
+                    self.assertEqual(sorted(os.listdir(sandbox)), ['app-2.log'])
+                    Path(sandbox, 'app-3.log').touch()
+                    os.utime(str(Path(sandbox, 'app-3.log')), (old, old))
+                    watcher.process_events(watcher.inotify.read_events(1))
+                    self.assertEqual(len(list(watcher.collector.devices.values())[0].files), 2)
+                    watcher.poll()
+                    self.assertEqual(sorted(os.listdir(sandbox)), ['app-2.log'])
+                    Path(sandbox, 'app-2.log').unlink()
+                    watcher.process_events(watcher.inotify.read_events(1))
+                    self.assertEqual(len(list(watcher.collector.devices.values())[0].files), 0)
+                self.assertIn('Overaged file: {}\n'.format(Path(sandbox, 'app-3.log')), fake_stdout.getvalue())
+            finally:
+                watcher.close()
+
+    def test_watcher_relative_file(self):
+        """Test watcher matches events of a bare relative file name with the scanned file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            cwd = os.getcwd()
+            os.chdir(sandbox)
+            Path('app-1.log').touch()
+            watcher = Watcher({'app-1.log'}, R_GROUP, {
+                'dry-run': False, 'recursive': False, 'poll-interval': 1, 'delete-jobs': 1,
+                'min-files-per-group': 0, 'min-free-space-on-device': 0, 'max-file-age': 10, 'min-file-age': 0
+            })
+            try:
+                watcher.scan()
+                Path('app-1.log').write_bytes(b'x' * 100000)
+                watcher.process_events(watcher.inotify.read_events(1))
+                files = list(watcher.collector.devices.values())[0].files
+                self.assertEqual(list(files), ['app-1.log'])
+                self.assertGreater(files['app-1.log'].blocks, 1)
+            finally:
+                watcher.close()
+                os.chdir(cwd)
+
+    def test_collect_files_jobs(self):
+        """Test concurrent scan gives the same result as sequential one"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            paths = []
+            for i in range(5):
+                path = Path(sandbox, 'dir{}'.format(i))
+                path.mkdir()
+                for j in range(20):
+                    Path(path, 'app{}-{}.log'.format(j % 3, j)).touch()
+                paths.append(str(path))
+            paths.append(str(Path(sandbox, 'dir0', 'app0-0.log')))
+            now = time.time()
+            sequential = collect_files(paths, R_GROUP, 0, now)
+            concurrent = collect_files(paths, R_GROUP, 0, now, jobs=4)
+            self.assertEqual(list(sequential), list(concurrent))
+            for st_dev, device in sequential.items():
+                self.assertEqual(
+                    [(f.name, f.group_id, f.blocks, f.age) for f in device.files.values()],
+                    [(f.name, f.group_id, f.blocks, f.age) for f in concurrent[st_dev].files.values()]
+                )
+                self.assertEqual(device.group_counters, concurrent[st_dev].group_counters)
@@ -8,9 +8,14 @@ from pathlib import Path
 import tempfile
 import io
 import datetime
+import errno
+import os
+import gzip
+import time
 from tplogtools.logrotlib import human_size_units_to_base, need_to_rotate_log
 from tplogtools.logrotlib import process_log, run_compressors, get_spec_config
-from tplogtools.logrotlib import process_path
+from tplogtools.logrotlib import process_path, process_paths, RuleSet, Watcher
+from tplogtools.metrics import RunMetrics
 
 class TestLogrotlib(unittest.TestCase):
     """Main test class"""
@@ -339,13 +344,14 @@ class TestLogrotlib(unittest.TestCase):
                 firstfile.touch()
                 secondfile = Path(sandbox, 'second.log')
                 secondfile.touch()
-                run_compressors(
-                    [
-                        [str(sandbox), 'false'],
-                        [str(sandbox), 'gzip', '-9', str(firstfile)],
-                        [str(sandbox), 'gzip', '-9', str(secondfile)]
-                    ]
-                )
+                with self.assertLogs():
+                    run_compressors(
+                        [
+                            [str(sandbox), 'false'],
+                            [str(sandbox), 'gzip', '-9', str(firstfile)],
+                            [str(sandbox), 'gzip', '-9', str(secondfile)]
+                        ]
+                    )
                 self.assertEqual(fake_stdout.getvalue(), 'Executing compressors... done.\n')
                 self.assertFalse(firstfile.exists())
                 self.assertFalse(secondfile.exists())
@@ -374,7 +380,8 @@ class TestLogrotlib(unittest.TestCase):
                 self.assertFalse(secondfile.exists())
                 self.assertFalse(firstfile.with_suffix('.log.gz').exists())
                 self.assertTrue(secondfile.with_suffix('.log.gz').exists())
-                self.assertIn("FileNotFoundError: [Errno 2] No such file or directory: '{}'".format(bad_gzip), logger.output[0])
+                self.assertIn("FileNotFoundError: [Errno 2] No such file or directory: '{}'".format(bad_gzip), '\n'.join(logger.output))
+                self.assertIn('WARNING:root:compressor "false" failed with code 1', logger.output[0])
 
     def test_get_spec_config_empty(self):
         """Test get_spec_config on empty conf"""
@@ -420,3 +427,349 @@ class TestLogrotlib(unittest.TestCase):
         }
         get_spec_config(conf, 'filematch')
         self.assertEqual(conf['defaults'], {'default_foo': 'default_bar', 'foo': 'bar'})
+
+    def test_rule_set(self):
+        """Test compiled rules resolve the same config as get_spec_config"""
+        conf = {
+            'defaults': {'min_size': '1M', 'max_size': '4G', 'interval': 'daily', 'compress': 'bzip2'},
+            'specific': [
+                {'mask': ['httpd-*.log', 'nginx_*.log'], 'ignore': True},
+                {'mask': ['logfile.log', 'nginx_a.log'], 'interval': 'hourly', 'min_size': '500M'},
+                {'mask': ['[ab]?.log'], 'max_size': 10}
+            ]
+        }
+        rules = RuleSet(conf)
+        for filename in ('httpd-x.log', 'nginx_a.log', 'logfile.log', 'a1.log', 'c1.log', 'other.log'):
+            expected = get_spec_config(conf, filename)
+            for key in ('min_size', 'max_size'):
+                expected[key] = human_size_units_to_base(expected[key])
+            self.assertEqual(rules.get_config(filename), expected, filename)
+        self.assertIs(rules.get_config('logfile.log'), rules.get_config('logfile.log'))
+        with self.assertRaises(TypeError):
+            rules.get_config('logfile.log')['ignore'] = True
+
+    def test_rule_set_errors(self):
+        """Test configuration errors are reported at load time"""
+        self.assertRaisesRegex(ValueError, 'Bad min_size in specific rule 1: Bad unit "X"', RuleSet, {'specific': [{'mask': ['a'], 'min_size': '1X'}]})
+        self.assertRaisesRegex(ValueError, 'Mask of specific rule 1 must be a list', RuleSet, {'specific': [{'mask': 'a'}]})
+        self.assertRaisesRegex(ValueError, 'Mask of specific rule 1 must be a list', RuleSet, {'specific': [{'mask': None}]})
+        self.assertRaisesRegex(ValueError, 'Mask of specific rule 2 must be a list', RuleSet, {'specific': [{'mask': ['a']}, {'mask': ['b', 1]}]})
+        self.assertRaisesRegex(ValueError, 'Specific rule 1 must be a mapping', RuleSet, {'specific': ['a']})
+        self.assertRaisesRegex(ValueError, 'Configuration and its defaults must be mappings', RuleSet, ['a'])
+        self.assertRaisesRegex(ValueError, 'Bad interval "weekly" in defaults', RuleSet, {'defaults': {'interval': 'weekly'}})
+        self.assertRaisesRegex(ValueError, 'Bad compress in defaults', RuleSet, {'defaults': {'compress': 'gzip "'}})
+        self.assertEqual(RuleSet(None).get_config('a.log'), {})
+
+    def test_run_compressors_parallel(self):
+        """Test run_compressors with more jobs and per device limit"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                with self.assertLogs(level='INFO') as logger:
+                    files = [Path(sandbox, 'file{}.log'.format(i)) for i in range(4)]
+                    for logfile in files:
+                        logfile.touch()
+                    results = run_compressors([[str(sandbox), 'gzip', str(logfile)] for logfile in files], jobs=3, device_jobs=2)
+                self.assertEqual(fake_stdout.getvalue(), 'Executing compressors... done.\n')
+                self.assertEqual(sorted(result[0][-1] for result in results), [str(logfile) for logfile in files])
+                self.assertEqual([result[1] for result in results], [0, 0, 0, 0])
+                for logfile in files:
+                    self.assertTrue(logfile.with_suffix('.log.gz').exists())
+                self.assertRegex(logger.output[-1], 'INFO:root:4 compressors finished in [0-9.]+ s, 0 failed')
+
+    def test_run_compressors_builtin(self):
+        """Test run_compressors with builtin compressor"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()):
+                Path(sandbox, 'backup').mkdir()
+                logfile = Path(sandbox, 'backup', 'first.log')
+                logfile.write_bytes(b'content\n' * 1000)
+                results = run_compressors([[str(sandbox), 'builtin:gzip:6:2', 'backup/first.log']], jobs=2)
+                self.assertEqual([result[1] for result in results], [0])
+                self.assertFalse(logfile.exists())
+                self.assertTrue(logfile.with_suffix('.log.gz').exists())
+        self.assertRaisesRegex(ValueError, 'Bad compress in defaults: Bad builtin compressor', RuleSet, {'defaults': {'compress': 'builtin:rar'}})
+
+    def test_process_log_with_compress_on_move(self):
+        """Tests of rotation to other filesystem compressed while copying"""
+        def exdev_rename(source, target):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), source, None, target)
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout, mock.patch('os.rename', new=exdev_rename):
+                srcfile = Path(sandbox, 'pokus.log')
+                srcfile.write_bytes(b'line\n' * 100)
+                destfile = Path(sandbox, 'backup', 'pokus.log')
+                compressors = process_log(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {
+                        'target': '{{path}}/backup/{{name}}.{{ext}}',
+                        'interval': 'hourly',
+                        'compress': 'builtin:gzip',
+                        'compress_on_move': True
+                    },
+                    'hourly',
+                    str(srcfile),
+                    10
+                )
+                self.assertEqual(compressors, [])
+                self.assertFalse(srcfile.exists())
+                self.assertFalse(destfile.exists())
+                self.assertEqual(gzip.decompress(destfile.with_suffix('.log.gz').read_bytes()), b'line\n' * 100)
+                self.assertEqual(fake_stdout.getvalue(), 'Checking "{src}"... rotating... "{src}" -> "{dest}" done.\n'.format(src=srcfile, dest=destfile))
+
+    def test_process_paths(self):
+        """Test parallel processing keeps output and compressors in order of paths"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                with self.assertLogs() as logger:
+                    paths = []
+                    for i in range(4):
+                        path = Path(sandbox, 'dir{}'.format(i))
+                        path.mkdir()
+                        Path(path, 'app.log').touch()
+                        paths.append(str(path))
+                    paths.insert(2, str(Path(sandbox, 'missing')))
+                    compressors = process_paths(
+                        datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                        {'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'hourly', 'compress': 'gzip'}},
+                        'hourly',
+                        paths,
+                        jobs=3
+                    )
+                self.assertEqual(compressors, [[path, 'gzip', 'backup/app.log'] for path in paths if not path.endswith('missing')])
+                self.assertEqual(fake_stdout.getvalue(), ''.join(
+                    'Checking "{src}"... rotating... "{src}" -> "backup/app.log" done.\n'.format(src=Path(path, 'app.log'))
+                    for path in paths if not path.endswith('missing')
+                ))
+                self.assertIn('Processing of path "{}" failed'.format(Path(sandbox, 'missing')), logger.output[0])
+
+    def test_process_path_with_exec_batch(self):
+        """Test hooks of batched rule run once for all rotated files"""
+        with tempfile.TemporaryDirectory() as sandbox, tempfile.TemporaryDirectory() as calls_dir:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                calls = Path(calls_dir, 'calls')
+                for name in ('a.log', 'b.log', 'skip.log'):
+                    Path(sandbox, name).touch()
+                hook = "sh -c 'echo \"$0 $*\" >> {}'".format(calls)
+                compressors = process_path(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {
+                        'defaults': {
+                            'target': 'backup/{{name}}.{{ext}}',
+                            'interval': 'hourly',
+                            'compress': 'gzip',
+                            'exec_pre': hook + ' pre',
+                            'exec_post': hook + ' post',
+                            'exec_batch': True
+                        },
+                        'specific': [{'mask': ['skip.log'], 'min_size': 100}]
+                    },
+                    'hourly',
+                    sandbox
+                )
+                self.assertEqual(sorted(compressors), [[sandbox, 'gzip', 'backup/a.log'], [sandbox, 'gzip', 'backup/b.log']])
+                self.assertEqual(sorted(calls.read_text().splitlines()), ['post backup/a.log backup/b.log', 'pre a.log b.log'])
+                self.assertEqual(sorted(fake_stdout.getvalue().splitlines()), [
+                    'Checking "{src}"... rotating... "{src}" -> "backup/{name}" done.'.format(src=Path(sandbox, name), name=name)
+                    for name in ('a.log', 'b.log')
+                ] + ['Checking "{}"... rotation not needed.'.format(Path(sandbox, 'skip.log'))])
+
+    def test_process_path_with_failed_exec_batch(self):
+        """Test failure of batched exec_pre is reported for each file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout, self.assertLogs() as logger:
+                for name in ('a.log', 'b.log'):
+                    Path(sandbox, name).touch()
+                compressors = process_path(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'hourly', 'exec_pre': '/bin/false', 'exec_batch': True}},
+                    'hourly',
+                    sandbox
+                )
+                self.assertEqual(compressors, [])
+                self.assertTrue(Path(sandbox, 'a.log').exists())
+                self.assertEqual(sorted(fake_stdout.getvalue().splitlines()), [
+                    'Checking "{}"... exec_pre failed.'.format(Path(sandbox, name)) for name in ('a.log', 'b.log')
+                ])
+                self.assertEqual(len(logger.output), 1)
+                self.assertIn('exec_pre "/bin/false a.log b.log" failed with code 1', logger.output[0])
+
+    def test_process_log_with_copytruncate(self):
+        """Tests of rotation by copy and truncation of the live log"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                srcfile = Path(sandbox, 'pokus.log')
+                srcfile.write_bytes(b'line\n' * 100)
+                destfile = Path(sandbox, 'backup', 'pokus.log')
+                compressors = process_log(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {'target': '{{path}}/backup/{{name}}.{{ext}}', 'interval': 'hourly', 'compress': 'gzip', 'copytruncate': True},
+                    'hourly',
+                    str(srcfile),
+                    500
+                )
+                self.assertEqual(compressors, [[sandbox, 'gzip', str(destfile)]])
+                self.assertEqual(srcfile.read_bytes(), b'')
+                self.assertEqual(destfile.read_bytes(), b'line\n' * 100)
+                self.assertEqual(fake_stdout.getvalue(), 'Checking "{src}"... rotating... "{src}" -> "{dest}" done.\n'.format(src=srcfile, dest=destfile))
+
+    def test_process_paths_with_metrics(self):
+        """Test outcomes, sizes and stages are collected during the run"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()):
+                Path(sandbox, 'big.log').write_bytes(b'line\n' * 100)
+                Path(sandbox, 'small.log').write_bytes(b'line\n')
+                metrics = RunMetrics('logrot')
+                compressors = process_paths(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'daily', 'max_size': 100, 'compress': 'gzip'}},
+                    'hourly',
+                    [sandbox],
+                    metrics=metrics
+                )
+                run_compressors(compressors, metrics=metrics)
+        summary = metrics.summary()
+        self.assertEqual(summary['outcomes'], {'rotated': 1, 'not_needed': 1})
+        self.assertEqual(summary['rotated_bytes'], 500)
+        self.assertEqual(summary['compressed_bytes'], 500)
+        self.assertEqual(summary['compress_failed'], 0)
+        self.assertEqual(sorted(summary['stages']), ['compress', 'move', 'scan'])
+        self.assertEqual([record['file'] for record in summary['compressors']], [str(Path(sandbox, 'backup', 'big.log'))])
+
+    def test_process_path_with_exec_batch_metrics(self):
+        """Test batch without exec_post records no exec_post stage"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('sys.stdout', new=io.StringIO()):
+                Path(sandbox, 'a.log').touch()
+                metrics = RunMetrics('logrot')
+                process_path(
+                    datetime.datetime(year=2019, month=1, day=10, hour=21, minute=30),
+                    {'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'hourly', 'exec_pre': 'true', 'exec_batch': True}},
+                    'hourly',
+                    sandbox,
+                    metrics=metrics
+                )
+        self.assertEqual(sorted(metrics.summary()['stages']), ['exec_pre', 'move', 'scan'])
+
+    def test_watcher(self):
+        """Test watcher rotates log as soon as it reaches max_size and debounces checks"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            log = Path(sandbox, 'app.log')
+            log.write_bytes(b'line\n')
+            Path(sandbox, 'other.txt').write_bytes(b'line\n' * 100)
+            rules = RuleSet({
+                'defaults': {'target': 'backup/{{name}}-%Y%m%d%H%M%S.{{ext}}', 'interval': 'daily', 'max_size': 50, 'compress': 'gzip'},
+                'specific': [{'mask': ['*.txt'], 'ignore': True}],
+            })
+            watcher = Watcher(rules, [sandbox], debounce=0)
+            try:
+                with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+                    watcher.scan()
+                    self.assertEqual(list(watcher.pending), [str(log)])
+                    watcher.check_pending()
+                    self.assertEqual(watcher.stats[str(log)]['checks'], 1)
+                    with log.open('ab') as output:
+                        for _ in range(10):
+                            output.write(b'line\n')
+                            output.flush()
+                    watcher.debounce = 60
+                    watcher.step()
+                    self.assertFalse(log.exists())
+                    self.assertEqual(watcher.stats[str(log)]['rotations'], 1)
+                    self.assertIn('rotating...', fake_stdout.getvalue())
+                    log.write_bytes(b'line\n' * 20)
+                    watcher.process_events(watcher.inotify.read_events(1))
+                    watcher.check_pending()
+                    self.assertTrue(log.exists())
+                    self.assertGreater(watcher.pending[str(log)], time.monotonic())
+                    self.assertIn('2 checks', watcher.format_stats())
+            finally:
+                with mock.patch('sys.stdout', new=io.StringIO()):
+                    watcher.close()
+            backups = os.listdir(os.path.join(sandbox, 'backup'))
+            self.assertEqual(len(backups), 1)
+            self.assertTrue(backups[0].endswith('.log.gz'), backups)
+
+    def test_watcher_rotates_twice_within_target_period(self):
+        """Test watcher gives a unique name to the second target of the same hour"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            log = Path(sandbox, 'app.log')
+            rules = RuleSet({
+                'defaults': {'target': 'backup/{{name}}-%Y%m%d%H.{{ext}}', 'interval': 'daily', 'max_size': 50, 'compress': 'gzip'},
+            })
+            watcher = Watcher(rules, [sandbox], debounce=0)
+            now = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+            try:
+                with mock.patch('sys.stdout', new=io.StringIO()), mock.patch('tplogtools.logrotlib.local_tz_now', return_value=now):
+                    for content in (b'first\n' * 20, b'second\n' * 20):
+                        log.write_bytes(content)
+                        watcher.schedule(str(log))
+                        watcher.check_pending()
+                        self.assertFalse(log.exists())
+                        watcher.compressor_thread.join()
+                    self.assertEqual(watcher.retry_delays, {})
+            finally:
+                with mock.patch('sys.stdout', new=io.StringIO()):
+                    watcher.close()
+            backup = Path(sandbox, 'backup')
+            self.assertEqual(sorted(os.listdir(str(backup))), ['app-2020010203.1.log.gz', 'app-2020010203.log.gz'])
+            with gzip.open(str(backup / 'app-2020010203.log.gz')) as compressed:
+                self.assertEqual(compressed.read(), b'first\n' * 20)
+            with gzip.open(str(backup / 'app-2020010203.1.log.gz')) as compressed:
+                self.assertEqual(compressed.read(), b'second\n' * 20)
+
+    def test_watcher_compressors_share_jobs(self):
+        """Test compressors of a burst of rotations run by one scheduler, so jobs hold for all of them"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            rules = RuleSet({
+                'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'daily', 'max_size': 50, 'compress': 'gzip'},
+            })
+            watcher = Watcher(rules, [sandbox], debounce=0)
+            running = []
+            overlaps = []
+            compressed = []
+            def compress(compressors, jobs, device_jobs):
+                overlaps.append(bool(running))
+                running.append(compressors)
+                time.sleep(0.1)
+                compressed.extend(compressor[-1] for compressor in compressors)
+                running.remove(compressors)
+            try:
+                with mock.patch('sys.stdout', new=io.StringIO()), mock.patch('tplogtools.logrotlib.run_compressors', side_effect=compress):
+                    for name in ('a.log', 'b.log', 'c.log'):
+                        Path(sandbox, name).write_bytes(b'line\n' * 20)
+                        watcher.schedule(str(Path(sandbox, name)))
+                    watcher.check_pending()
+                    self.assertEqual(len(watcher.queued_compressors), 2)
+                    watcher.compressor_thread.join()
+                    watcher.start_compressors()
+                    self.assertEqual(watcher.queued_compressors, [])
+                    watcher.compressor_thread.join()
+            finally:
+                watcher.close()
+            self.assertEqual(overlaps, [False, False])
+            self.assertEqual(sorted(compressed), ['backup/a.log', 'backup/b.log', 'backup/c.log'])
+
+    def test_watcher_backs_off_after_failed_rotation(self):
+        """Test watcher warns and postpones the next check of log it failed to rotate"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            log = Path(sandbox, 'app.log')
+            log.write_bytes(b'line\n' * 20)
+            rules = RuleSet({
+                'defaults': {'target': 'backup/{{name}}.{{ext}}', 'interval': 'daily', 'max_size': 50, 'exec_pre': 'false'},
+            })
+            watcher = Watcher(rules, [sandbox], debounce=0)
+            try:
+                with mock.patch('sys.stdout', new=io.StringIO()), self.assertLogs(level=logging.WARNING) as logs:
+                    for delay in (60, 120):
+                        watcher.schedule(str(log))
+                        watcher.pending[str(log)] = 0.0
+                        watcher.check_pending()
+                        self.assertTrue(log.exists())
+                        self.assertEqual(watcher.retry_delays[str(log)], delay)
+                        self.assertGreater(watcher.next_check[str(log)], time.monotonic() + delay - 5)
+                self.assertIn('Rotation of "{}" failed, next try in 120 s'.format(log), logs.output[-1])
+                watcher.schedule(str(log))
+                self.assertGreater(watcher.pending[str(log)], time.monotonic())
+            finally:
+                with mock.patch('sys.stdout', new=io.StringIO()):
+                    watcher.close()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Unit-tests for logschedlib"""
+
+import unittest
+from unittest import mock
+import io
+import logging
+import os
+import time
+import datetime
+import tempfile
+import contextlib
+from pathlib import Path
+from tplogtools.logschedlib import DirSnapshot, Scheduler, parse_config, seconds_to_interval
+
+def make_old(filename, days):
+    """Set mtime of file given number of days to the past"""
+    old = time.time() - days * 86400
+    os.utime(filename, (old, old))
+
+class TestLogschedlib(unittest.TestCase):
+    """Main test class"""
+
+    def test_snapshot_reuses_unchanged_directory(self):
+        """Listing is reused until the directory is changed"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'a.log').write_text('a')
+            os.mkdir(os.path.join(sandbox, 'sub'))
+            os.symlink('missing', os.path.join(sandbox, 'dangling'))
+            make_old(sandbox, 1)
+            snapshot = DirSnapshot()
+            self.assertEqual(sorted(name for name, _, _ in snapshot.list_dir(sandbox)), ['a.log', 'sub'])
+            self.assertEqual([name for _, name, _ in snapshot.list_files(sandbox)], ['a.log'])
+            self.assertEqual((snapshot.misses, snapshot.hits), (1, 1))
+            Path(sandbox, 'b.log').write_text('b')
+            self.assertEqual(sorted(name for _, name, _ in snapshot.list_files(sandbox)), ['a.log', 'b.log'])
+            self.assertEqual((snapshot.misses, snapshot.hits), (2, 1))
+
+    def test_snapshot_does_not_keep_racy_directory(self):
+        """Directory changed within racy seconds is listed again"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'a.log').write_text('a')
+            snapshot = DirSnapshot()
+            snapshot.list_dir(sandbox)
+            snapshot.list_dir(sandbox)
+            self.assertEqual((snapshot.misses, snapshot.hits), (2, 0))
+
+    def test_parse_config(self):
+        """Defaults are filled in and bad values refused"""
+        config = parse_config({'logrot': {'paths': ['/tmp']}, 'schedule': {'hourly': 5, 'daily': '02:30'}})
+        self.assertEqual(config['hourly'], (None, 5))
+        self.assertEqual(config['daily'], (2, 30))
+        self.assertEqual(config['clean_paths'], [])
+        self.assertEqual(config['max_file_age'], 99999)
+        with self.assertRaises(ValueError):
+            parse_config({})
+        with self.assertRaises(ValueError):
+            parse_config({'logclean': {'max_file_age': 3}})
+        with self.assertRaises(ValueError):
+            parse_config({'logrot': {'paths': ['/tmp']}, 'schedule': {'hourly': 60}})
+        with self.assertRaises(ValueError):
+            parse_config({'logrot': {'paths': ['/tmp'], 'rules': {'defaults': {'interval': 'weekly'}}}})
+
+    def test_seconds_to_interval(self):
+        """Hourly timer waits for its minute of the next hour, daily one for its time of day"""
+        config = {'hourly': (None, 5), 'daily': (2, 30)}
+        now = datetime.datetime(2020, 1, 1, 10, 10, 0)
+        self.assertEqual(seconds_to_interval(now, 'hourly', config), 55 * 60)
+        self.assertEqual(seconds_to_interval(now.replace(minute=0), 'hourly', config), 5 * 60)
+        self.assertEqual(seconds_to_interval(now.replace(minute=5), 'hourly', config), 3600)
+        self.assertEqual(seconds_to_interval(now, 'daily', config), (16 * 60 + 20) * 60)
+
+    def test_seconds_to_interval_over_dst(self):
+        """Daily timer counts in the hour skipped by the change to summer time"""
+        with mock.patch.dict(os.environ, {'TZ': 'Europe/Prague'}):
+            time.tzset()
+            try:
+                now = datetime.datetime(2020, 3, 28, 23, 0, 0)
+                self.assertEqual(seconds_to_interval(now, 'daily', {'daily': (3, 0)}), 3 * 3600)
+            finally:
+                os.environ.pop('TZ')
+        time.tzset()
+
+    def test_timers_are_rearmed_by_wall_clock_after_run(self):
+        """Expired timers are returned and set again by the wall clock after their run"""
+        clock = mock.Mock(return_value=1000.0)
+        to_interval = mock.Mock(side_effect=lambda now, interval, config: {'hourly': 10, 'daily': 100}[interval])
+        with mock.patch('tplogtools.logschedlib.seconds_to_interval', to_interval):
+            scheduler = Scheduler(lambda: {'logrot': {'paths': ['/tmp']}}, clock)
+            try:
+                self.assertEqual(scheduler.due(), [])
+                clock.return_value = 1010.0
+                with mock.patch.object(scheduler, 'wait'), mock.patch.object(scheduler, 'run_intervals') as run_intervals:
+                    scheduler.step()
+                run_intervals.assert_called_once_with(['hourly'])
+                self.assertEqual(scheduler.deadlines, {'hourly': 1080.0, 'daily': 1100.0})
+                # the timer is set from one minute after the run, so an early fire does not repeat the run
+                self.assertGreater(to_interval.call_args[0][0], datetime.datetime.now() + datetime.timedelta(seconds=50))
+            finally:
+                scheduler.close()
+
+    def test_failed_run_keeps_schedule(self):
+        """Exception of a run is logged and its timers are set again"""
+        clock = mock.Mock(return_value=1000.0)
+        to_interval = mock.Mock(side_effect=lambda now, interval, config: {'hourly': 10, 'daily': 100}[interval])
+        with mock.patch('tplogtools.logschedlib.seconds_to_interval', to_interval):
+            scheduler = Scheduler(lambda: {'logrot': {'paths': ['/tmp']}}, clock)
+            try:
+                clock.return_value = 1010.0
+                with mock.patch.object(scheduler, 'wait'), mock.patch.object(scheduler, 'run_intervals', side_effect=FileNotFoundError('gone')):
+                    with self.assertLogs(level=logging.ERROR) as logs:
+                        scheduler.step()
+                self.assertIn('Run of hourly failed', logs.output[0])
+                self.assertEqual(scheduler.deadlines, {'hourly': 1080.0, 'daily': 1100.0})
+            finally:
+                scheduler.close()
+
+    def test_compressors_of_runs_do_not_overlap(self):
+        """Compressors of the next run wait for those of the previous one"""
+        scheduler = Scheduler(lambda: {'logrot': {'paths': ['/tmp']}})
+        running = []
+        overlaps = []
+        def compress(compressors, jobs, device_jobs):
+            overlaps.append(bool(running))
+            running.append(compressors)
+            time.sleep(0.1)
+            running.remove(compressors)
+        try:
+            with mock.patch('tplogtools.logschedlib.run_compressors', side_effect=compress):
+                scheduler.start_compressors(['first'], scheduler.config)
+                scheduler.start_compressors(['second'], scheduler.config)
+                scheduler.compressor_thread.join()
+        finally:
+            scheduler.close()
+        self.assertEqual(overlaps, [False, False])
+
+    def test_reload_keeps_config_on_error(self):
+        """Broken configuration is logged and the previous one stays"""
+        confs = [{'logrot': {'paths': ['/tmp']}}, {}, {'logrot': {'paths': ['/var']}}]
+        scheduler = Scheduler(lambda: confs.pop(0))
+        try:
+            scheduler.request_reload()
+            self.assertTrue(scheduler.reload_requested)
+            with self.assertLogs(level='ERROR'):
+                self.assertFalse(scheduler.reload())
+            self.assertEqual(scheduler.config['rot_paths'], ['/tmp'])
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.assertTrue(scheduler.reload())
+            self.assertEqual(scheduler.config['rot_paths'], ['/var'])
+            self.assertFalse(scheduler.reload_requested)
+        finally:
+            scheduler.close()
+
+    def test_run_intervals_rotates_and_cleans(self):
+        """Rotation and cleanup share the snapshot, compression runs in background"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            Path(sandbox, 'app.log').write_text('line\n')
+            os.mkdir(os.path.join(sandbox, 'oldlogs'))
+            Path(sandbox, 'oldlogs', 'app-1.log').write_text('old\n')
+            make_old(os.path.join(sandbox, 'oldlogs', 'app-1.log'), 10)
+            make_old(os.path.join(sandbox, 'oldlogs'), 1)
+            conf = {
+                'logrot': {'paths': [sandbox], 'rules': {'defaults': {
+                    'interval': 'hourly',
+                    'target': 'oldlogs/{{name}}-%Y%m%d%H%M%S.{{ext}}',
+                    'compress': 'gzip',
+                }}},
+                'logclean': {'paths': [os.path.join(sandbox, 'oldlogs')], 'max_file_age': 5},
+            }
+            scheduler = Scheduler(lambda: conf)
+            output = io.StringIO()
+            try:
+                with contextlib.redirect_stdout(output):
+                    snapshot = scheduler.run_intervals(['hourly'])
+            finally:
+                with contextlib.redirect_stdout(output):
+                    scheduler.close()
+            self.assertFalse(os.path.exists(os.path.join(sandbox, 'app.log')))
+            backups = os.listdir(os.path.join(sandbox, 'oldlogs'))
+            self.assertEqual(len(backups), 1)
+            self.assertTrue(backups[0].startswith('app-') and backups[0].endswith('.log.gz'), backups)
+            self.assertEqual((snapshot.misses, snapshot.hits), (2, 0))
+            self.assertIn('Removed 1 files', output.getvalue())
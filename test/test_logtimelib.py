@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""Unit-tests for logtimelib"""
+
+import unittest
+from unittest import mock
+import threading
+import time
+import io
+import os
+import tempfile
+from pathlib import Path
+from tplogtools.logtimelib import OutputBuffer, copy_chunks, copy_lines, write_vectors, copy_sources, open_source
+
+class FakeOutput(io.BytesIO):
+    """Output counting calls of flush"""
+    def __init__(self):
+        super().__init__()
+        self.flushes = 0
+
+    def flush(self):
+        self.flushes += 1
+
+class FakeFormatter:
+    """Formatter numbering calls instead of time"""
+    def __init__(self):
+        self.calls = 0
+
+    def format(self, timestamp):
+        self.calls += 1
+        return 'T{}'.format(self.calls)
+
+class TestLogtimelib(unittest.TestCase):
+    """Main test class"""
+
+    def test_flush_each_write(self):
+        """Test each write is flushed without limits"""
+        output = FakeOutput()
+        buffer = OutputBuffer(output)
+        buffer.write(b'a\n')
+        buffer.write(b'b\n')
+        self.assertEqual(output.getvalue(), b'a\nb\n')
+        self.assertEqual(output.flushes, 2)
+
+    def test_flush_by_size(self):
+        """Test writes are batched up to max_bytes"""
+        output = FakeOutput()
+        buffer = OutputBuffer(output, max_bytes=5)
+        buffer.write(b'a\n')
+        buffer.write(b'b\n')
+        self.assertEqual(output.getvalue(), b'')
+        buffer.write(b'c\n')
+        self.assertEqual(output.getvalue(), b'a\nb\nc\n')
+        buffer.write(b'd\n')
+        buffer.flush()
+        self.assertEqual(output.getvalue(), b'a\nb\nc\nd\n')
+        self.assertEqual(output.flushes, 2)
+
+    def test_flush_by_delay(self):
+        """Test batch is flushed by alarm after max_delay"""
+        output = FakeOutput()
+        buffer = OutputBuffer(output, max_bytes=1000, max_delay=0.05)
+        buffer.write(b'a\n')
+        buffer.write(b'b\n')
+        self.assertEqual(output.getvalue(), b'')
+        time.sleep(0.2)
+        self.assertEqual(output.getvalue(), b'a\nb\n')
+        self.assertEqual(output.flushes, 1)
+
+    def test_alarm_during_write(self):
+        """Test alarm in the middle of write is postponed"""
+        output = FakeOutput()
+        buffer = OutputBuffer(output, max_delay=10)
+        buffer.write(b'a\n')
+        buffer.in_write = True
+        buffer.alarm_handler()
+        self.assertEqual(output.getvalue(), b'')
+        buffer.in_write = False
+        buffer.write(b'b\n')
+        self.assertEqual(output.getvalue(), b'a\nb\n')
+
+    def copy_chunks(self, parts, read_size, formatter=None, **limits):
+        """Feed parts of input through pipe to copy_chunks, each part is read separately"""
+        output = OutputBuffer(FakeOutput(), **limits)
+        read_fd, write_fd = os.pipe()
+        def feed():
+            for part in parts:
+                os.write(write_fd, part)
+                time.sleep(0.02)
+            os.close(write_fd)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        try:
+            copy_chunks(read_fd, output, formatter or FakeFormatter(), read_size)
+            output.flush()
+        finally:
+            feeder.join()
+            os.close(read_fd)
+        return output.output.getvalue()
+
+    def test_copy_chunks(self):
+        """Test lines of one chunk share time, partial line gets time of its completion"""
+        self.assertEqual(self.copy_chunks([b'a\nb\nc', b'c\n', b'd'], 16), b'T1 a\nT1 b\nT2 cc\nT4 d')
+
+    def test_copy_chunks_long_line(self):
+        """Test lines longer than buffer are written in parts with one time"""
+        formatter = mock.Mock()
+        formatter.format.return_value = 'T'
+        self.assertEqual(self.copy_chunks([b'a\n0123456789', b'0123456789\nb\n'], 8, formatter), b'T a\nT 01234567890123456789\nT b\n')
+
+    def test_copy_chunks_batched(self):
+        """Test chunks are copied before buffer is reused"""
+        self.assertEqual(self.copy_chunks([b'a\nb', b'b\nc\n'], 4, max_bytes=100), b'T1 a\nT2 bb\nT3 c\n')
+
+    def test_copy_lines(self):
+        """Test line by line copy"""
+        output = FakeOutput()
+        copy_lines(io.BytesIO(b'a\nb'), output, FakeFormatter())
+        self.assertEqual(output.getvalue(), b'T1 a\nT2 b')
+
+    def test_write_vectors(self):
+        """Test writev of more chunks than IOV_MAX with partial writes"""
+        read_fd, write_fd = os.pipe()
+        chunks = [b'%d\n' % i for i in range(3000)]
+        expected = b''.join(chunks)
+        received = []
+        def drain():
+            while True:
+                data = os.read(read_fd, 1000)
+                if not data:
+                    break
+                received.append(data)
+        reader = threading.Thread(target=drain)
+        reader.start()
+        write_vectors(write_fd, chunks)
+        os.close(write_fd)
+        reader.join()
+        os.close(read_fd)
+        self.assertEqual(b''.join(received), expected)
+
+    def test_copy_sources(self):
+        """Test lines of more sources are merged with tags and never mixed"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            fifo = os.path.join(sandbox, 'fifo')
+            os.mkfifo(fifo)
+            read_fd, write_fd = os.pipe()
+            sources = [open_source('out=' + fifo), open_source('fd:{}'.format(read_fd))]
+            self.assertEqual(sources[1], (read_fd, 'fd:{}'.format(read_fd)))
+            def feed():
+                with open(fifo, 'wb', 0) as fifo_output:
+                    fifo_output.write(b'a1\na2')
+                    time.sleep(0.05)
+                    os.write(write_fd, b'b1\n0123456789\n')
+                    time.sleep(0.05)
+                    fifo_output.write(b'a2\na3')
+                os.close(write_fd)
+            feeder = threading.Thread(target=feed)
+            feeder.start()
+            output = OutputBuffer(FakeOutput())
+            formatter = mock.Mock()
+            formatter.format.return_value = 'T'
+            try:
+                copy_sources(sources, output, formatter, 8, tags=True)
+            finally:
+                feeder.join()
+                for fd, _ in sources:
+                    os.close(fd)
+        self.assertEqual(output.output.getvalue().decode().splitlines(), [
+            'T out a1',
+            'T fd:{} b1'.format(read_fd),
+            'T fd:{} 01234567'.format(read_fd),
+            'T fd:{} 89'.format(read_fd),
+            'T out a2a2',
+            'T out a3',
+        ])
+
+    def test_copy_sources_regular_files(self):
+        """Test regular files given as path, descriptor or stdin are read together with a FIFO"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            for name in ('a', 'b', 'c'):
+                Path(sandbox, name).write_bytes(name.encode() + b'1\n' + name.encode() + b'2\n')
+            read_fd, write_fd = os.pipe()
+            os.write(write_fd, b'p1\n')
+            os.close(write_fd)
+            b_fd = os.open(os.path.join(sandbox, 'b'), os.O_RDONLY)
+            c_fd = os.open(os.path.join(sandbox, 'c'), os.O_RDONLY)
+            with mock.patch('sys.stdin', new=mock.Mock(**{'buffer.fileno.return_value': c_fd})):
+                sources = [
+                    open_source(os.path.join(sandbox, 'a')),
+                    open_source('b=fd:{}'.format(b_fd)),
+                    open_source('c=-'),
+                    open_source('p=fd:{}'.format(read_fd)),
+                ]
+            output = OutputBuffer(FakeOutput())
+            formatter = mock.Mock()
+            formatter.format.return_value = 'T'
+            try:
+                copy_sources(sources, output, formatter, 64, tags=True)
+            finally:
+                for fd, _ in sources:
+                    os.close(fd)
+        self.assertEqual(sorted(output.output.getvalue().decode().splitlines()), sorted([
+            'T {} a1'.format(os.path.join(sandbox, 'a')),
+            'T {} a2'.format(os.path.join(sandbox, 'a')),
+            'T b b1',
+            'T b b2',
+            'T c c1',
+            'T c c2',
+            'T p p1',
+        ]))
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Unit-tests for metrics"""
+
+import unittest
+from unittest import mock
+from pathlib import Path
+import tempfile
+import json
+import io
+from tplogtools.metrics import RunMetrics, timed, write_atomically
+
+class TestMetrics(unittest.TestCase):
+    """Main test class"""
+
+    def test_summary(self):
+        """Test outcomes and bytes are summed"""
+        metrics = RunMetrics('logrot')
+        with timed(metrics, 'scan'):
+            pass
+        metrics.add_stage('move', 1.5)
+        metrics.add_stage('move', 0.5)
+        metrics.add_file('a.log', 'rotated', 100, 0.1)
+        metrics.add_file('b.log', 'rotated', 50, 0.1)
+        metrics.add_file('c.log', 'not_needed', 10, 0.0)
+        metrics.add_compressor('a.log', 0, 100, 2.0)
+        metrics.add_compressor('b.log', 1, 50, 1.0)
+        summary = json.loads(metrics.to_json())
+        self.assertEqual(sorted(summary['stages']), ['move', 'scan'])
+        self.assertEqual(summary['stages']['move'], 2.0)
+        self.assertEqual(summary['outcomes'], {'rotated': 2, 'not_needed': 1})
+        self.assertEqual(summary['rotated_bytes'], 150)
+        self.assertEqual(summary['compressed_bytes'], 100)
+        self.assertEqual(summary['compress_seconds'], 2.0)
+        self.assertEqual(summary['compress_failed'], 1)
+        prometheus = metrics.to_prometheus().splitlines()
+        self.assertIn('logrot_stage_seconds{stage="move"} 2.000000', prometheus)
+        self.assertIn('logrot_files{outcome="rotated"} 2', prometheus)
+        self.assertIn('logrot_compress_failed 1', prometheus)
+        self.assertIn('# TYPE logrot_run_seconds gauge', prometheus)
+
+    def test_timed_without_metrics(self):
+        """Test timed does nothing without metrics"""
+        with timed(None, 'scan'):
+            result = True
+        self.assertTrue(result)
+
+    def test_write_atomically(self):
+        """Test file is replaced and no temporary file is left"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            target = Path(sandbox, 'logrot.prom')
+            target.write_text('old\n')
+            write_atomically(str(target), 'new\n')
+            self.assertEqual(target.read_text(), 'new\n')
+            self.assertEqual([path.name for path in Path(sandbox).iterdir()], ['logrot.prom'])
+        with mock.patch('sys.stdout', new=io.StringIO()) as fake_stdout:
+            write_atomically('-', 'content\n')
+        self.assertEqual(fake_stdout.getvalue(), 'content\n')
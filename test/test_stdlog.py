@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import os
+import time
 import unittest
+from unittest import mock
 import subprocess
 import datetime
-from tplogtools.timetools import how_many_seconds_to_time, local_tz_now
+from tplogtools.timetools import how_many_seconds_to_time, local_tz_now, TimestampFormatter
 
 class TestTimediff(unittest.TestCase):
 
@@ -22,3 +25,23 @@ class TestTimediff(unittest.TestCase):
         tz_name, tz_offset = date_result.stdout.strip().split(' ')
         self.assertEqual(tz_offset, now.strftime('%z'))
         self.assertEqual(tz_name, now.strftime('%Z'))
+
+    def test_timestamp_formatter(self):
+        """Test cached formatting matches isoformat of local time"""
+        formatter = TimestampFormatter()
+        for timestamp in (1579608797.075558, 1579608797.5, 1579608798.0, 1579608797.000001):
+            expected = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).astimezone().isoformat(timespec='microseconds')
+            self.assertEqual(formatter.format(timestamp), expected)
+
+    def test_timestamp_formatter_dst(self):
+        """Test UTC offset is refreshed at DST transitions"""
+        with mock.patch.dict(os.environ, {'TZ': 'Europe/Prague'}):
+            time.tzset()
+            try:
+                formatter = TimestampFormatter()
+                self.assertEqual(formatter.format(1585443599.25), '2020-03-29T01:59:59.250000+01:00')
+                self.assertEqual(formatter.format(1585443600.5), '2020-03-29T03:00:00.500000+02:00')
+                self.assertEqual(formatter.format(1603587599.75), '2020-10-25T02:59:59.750000+02:00')
+                self.assertEqual(formatter.format(1603587600.0), '2020-10-25T02:00:00.000000+01:00')
+            finally:
+                time.tzset()
@@ -0,0 +1,392 @@
+#!/usr/bin/env python3
+"""Unit-tests for stdout2loglib"""
+
+import unittest
+from unittest import mock
+from pathlib import Path
+import tempfile
+import threading
+import datetime
+import time
+import os
+import gzip
+import socket
+import signal
+import subprocess
+import sys
+from tplogtools.stdout2loglib import State, Writer, rotate, write_lines, copy_input, CompressorPool, load_collector, Collector, Stream, Connection
+
+class TestStdout2loglib(unittest.TestCase):
+    """Main test class"""
+
+    def create_state(self, sandbox, **params):
+        """Return state of live.log in sandbox"""
+        return State(
+            wanted_hour=0,
+            wanted_minute=0,
+            max_size=params.pop('max_size', None),
+            backup_mask=os.path.join(sandbox, 'backup', params.pop('backup_mask', 'live-%H%M%S%f.log')),
+            filename=os.path.join(sandbox, 'live.log'),
+            compressor=None,
+            **params
+        )
+
+    def feed(self, parts):
+        """Return read end of pipe fed by parts in background"""
+        read_fd, write_fd = os.pipe()
+        def feed():
+            for part in parts:
+                os.write(write_fd, part)
+                time.sleep(0.05)
+            os.close(write_fd)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        return read_fd, feeder
+
+    def test_buffered_write(self):
+        """Test size is counted in memory and data are written at max_buffer"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            live = Path(sandbox, 'live.log')
+            live.write_bytes(b'old\n')
+            state = self.create_state(sandbox, max_buffer=10, max_size=12)
+            self.assertEqual(state.size, 4)
+            state.write(b'abcd\n')
+            self.assertEqual(live.read_bytes(), b'old\n')
+            self.assertFalse(state.size_exceeded())
+            state.write(b'efgh\n')
+            self.assertEqual(live.read_bytes(), b'old\nabcd\nefgh\n')
+            self.assertEqual(state.size, 14)
+            self.assertTrue(state.size_exceeded())
+            state.write(b'ijkl\n')
+            state.close()
+            self.assertEqual(live.read_bytes(), b'old\nabcd\nefgh\nijkl\n')
+
+    def test_rotate_flushes_buffer(self):
+        """Test buffered data go to rotated file"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            state = self.create_state(sandbox, max_buffer=1000, backup_mask='live-%H.log')
+            state.write(b'first\n')
+            rotate(state, datetime.datetime(year=2020, month=1, day=1, hour=12))
+            state.write(b'second\n')
+            state.close()
+            self.assertEqual(Path(sandbox, 'backup', 'live-12.log').read_bytes(), b'first\n')
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'second\n')
+            self.assertEqual(state.size, 7)
+
+    def test_copy_input_rotates_on_lines(self):
+        """Test rotation by size never splits line"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            writer = Writer(self.create_state(sandbox, max_size=10))
+            writer.start()
+            read_fd, feeder = self.feed([b'line1\nli', b'ne2\nline3\n', b'last'])
+            try:
+                copy_input(read_fd, writer)
+            finally:
+                feeder.join()
+                os.close(read_fd)
+                writer.stop()
+            backups = sorted(Path(sandbox, 'backup').iterdir())
+            self.assertEqual([backup.read_bytes() for backup in backups], [b'line1\nline2\n', b'line3\nlast'])
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'')
+
+    def test_write_lines_rotates_within_chunk(self):
+        """Test one chunk of many lines is rotated right after each line reaching max_size"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            state = self.create_state(sandbox, max_size=10)
+            write_lines(state, b'aaaa\nbbbb\ncc\ndddddddddddd\ne\n')
+            state.close()
+            backups = sorted(Path(sandbox, 'backup').iterdir())
+            self.assertEqual([backup.read_bytes() for backup in backups], [b'aaaa\nbbbb\n', b'cc\ndddddddddddd\n'])
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'e\n')
+
+    def test_writer_flush_delay(self):
+        """Test buffered data are written after max_delay even without more input"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            writer = Writer(self.create_state(sandbox, max_buffer=1000, max_delay=0.01))
+            writer.start()
+            try:
+                writer.put(b'line\n')
+                time.sleep(0.3)
+                self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'line\n')
+            finally:
+                writer.stop()
+
+    def test_writer_rotation_time(self):
+        """Test rotation at wanted time is done by writer"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            with mock.patch('tplogtools.stdout2loglib.rotation_deadline', side_effect=[time.monotonic() + 0.05, time.monotonic() + 1000]):
+                writer = Writer(self.create_state(sandbox, backup_mask='live.log'))
+                writer.start()
+                try:
+                    writer.put(b'before\n')
+                    time.sleep(0.3)
+                    writer.put(b'after\n')
+                finally:
+                    writer.stop()
+            self.assertEqual(Path(sandbox, 'backup', 'live.log').read_bytes(), b'before\n')
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'after\n')
+
+    def test_writer_reaps_compressors_when_idle(self):
+        """Test finished compressor is reaped without further input"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            state = self.create_state(sandbox, max_size=5)
+            state.compressor = "sh -c 'sleep 0.2' sh"
+            writer = Writer(state)
+            writer.start()
+            try:
+                writer.put(b'line1\n')
+                for _ in range(40):
+                    time.sleep(0.05)
+                    if Path(sandbox, 'backup').exists() and not state.running_compressors:
+                        break
+                self.assertTrue(Path(sandbox, 'backup').exists())
+                self.assertEqual(state.running_compressors, [])
+            finally:
+                writer.stop()
+
+    def test_writer_overflow(self):
+        """Test full queue drops or spills input, spilled data keep order"""
+        lines = [b'line%d\n' % i for i in range(100)]
+        with tempfile.TemporaryDirectory() as sandbox:
+            writer = Writer(self.create_state(sandbox), queue_size=2, overflow='drop')
+            for line in lines:
+                writer.put(line)
+            writer.start()
+            writer.stop()
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b''.join(lines[:2]))
+            self.assertEqual((writer.stats['dropped'], writer.stats['dropped_bytes']), (98, sum(len(line) for line in lines[2:])))
+        with tempfile.TemporaryDirectory() as sandbox:
+            writer = Writer(self.create_state(sandbox), queue_size=2, overflow='spill')
+            for line in lines[:50]:
+                writer.put(line)
+            writer.start()
+            for line in lines[50:]:
+                writer.put(line)
+            writer.stop()
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b''.join(lines))
+            self.assertGreater(writer.stats['spilled_bytes'], 0)
+            self.assertEqual(os.listdir(sandbox), ['live.log'])
+        self.assertRaisesRegex(ValueError, 'Bad overflow policy "lose"', Writer, None, 1, 'lose')
+
+    def test_writer_failure_is_raised_by_any_policy(self):
+        """Test input is refused with OSError once the writer failed, whatever the overflow policy"""
+        for overflow in ('block', 'drop', 'spill'):
+            with tempfile.TemporaryDirectory() as sandbox:
+                writer = Writer(self.create_state(sandbox, max_size=10), queue_size=2, overflow=overflow)
+                writer.start()
+                with mock.patch('os.makedirs', side_effect=PermissionError('denied')), mock.patch('logging.exception'):
+                    writer.put(b'line\n' * 10)
+                    writer.join(5)
+                self.assertFalse(writer.is_alive())
+                self.assertRaisesRegex(OSError, 'Writer of ".*live.log" failed: denied', writer.put, b'line\n')
+                self.assertRaisesRegex(OSError, 'failed: denied', writer.stop)
+
+    def test_stream_compression(self):
+        """Test live log is written as independent gzip members, rotation only renames it"""
+        lines = [b'line%d\n' % i for i in range(1000)]
+        with tempfile.TemporaryDirectory() as sandbox:
+            state = self.create_state(sandbox, max_buffer=2000, stream_compressor='builtin:gzip:6:2', backup_mask='live-%H.log.gz')
+            for line in lines[:500]:
+                state.write(line)
+            state.flush()
+            self.assertEqual(gzip.decompress(Path(sandbox, 'live.log').read_bytes()), b''.join(lines[:500]))
+            self.assertEqual(state.size, Path(sandbox, 'live.log').stat().st_size)
+            for line in lines[500:]:
+                state.write(line)
+            rotate(state, datetime.datetime(year=2020, month=1, day=1, hour=12))
+            state.write(b'next\n')
+            executor = state.executor
+            state.close()
+            self.assertIsNone(state.executor)
+            self.assertTrue(executor._shutdown)
+            self.assertEqual(state.running_compressors, [])
+            self.assertEqual(gzip.decompress(Path(sandbox, 'backup', 'live-12.log.gz').read_bytes()), b''.join(lines))
+            self.assertEqual(gzip.decompress(Path(sandbox, 'live.log').read_bytes()), b'next\n')
+        with tempfile.TemporaryDirectory() as sandbox:
+            self.assertRaisesRegex(ValueError, 'Bad builtin compressor', self.create_state, sandbox, stream_compressor='builtin:rar')
+
+    def test_writer_flush_delay_of_compressed_blocks(self):
+        """Test blocks compressed in background are written after max_delay even without more input"""
+        def slow_compress(data, level):
+            time.sleep(0.1)
+            return gzip.compress(data, level)
+        with tempfile.TemporaryDirectory() as sandbox:
+            state = self.create_state(sandbox, max_buffer=10, max_delay=0.2, stream_compressor='builtin:gzip')
+            state.compress = slow_compress
+            writer = Writer(state)
+            writer.start()
+            try:
+                writer.put(b'line\n' * 10)
+                time.sleep(0.05)
+                self.assertIsNone(state.pending_since)
+                self.assertIsNotNone(state.flush_timeout())
+                time.sleep(0.5)
+                self.assertEqual(gzip.decompress(Path(sandbox, 'live.log').read_bytes()), b'line\n' * 10)
+            finally:
+                writer.stop()
+
+    def test_compressor_pool(self):
+        """Test pool runs at most jobs compressors"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            files = [Path(sandbox, 'file{}.log'.format(i)) for i in range(3)]
+            pool = CompressorPool(2)
+            for logfile in files:
+                logfile.write_bytes(b'line\n')
+                pool.submit(['gzip', str(logfile)])
+            self.assertEqual((len(pool.running), len(pool.pending)), (2, 1))
+            pool.wait()
+            self.assertEqual([logfile.with_suffix('.log.gz').exists() for logfile in files], [True, True, True])
+
+    def test_load_collector(self):
+        """Test streams inherit defaults and same rotation times are staggered"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            collector = load_collector({
+                'socket': os.path.join(sandbox, 'collector.sock'),
+                'stagger': 30,
+                'defaults': {'time': '00:00', 'size': 2},
+                'streams': {
+                    name: {'filename': os.path.join(sandbox, name + '.log'), 'backup': name + '-%H.log'}
+                    for name in ('a', 'b', 'c')
+                }
+            })
+            self.assertEqual([collector.streams[name].offset for name in 'abc'], [0, 30, 60])
+            self.assertEqual(collector.streams['b'].state.max_size, 2 * 1024 * 1024)
+            self.assertAlmostEqual(collector.streams['b'].deadline - collector.streams['a'].deadline, 30, places=1)
+            for stream in collector.streams.values():
+                stream.state.close()
+        self.assertRaisesRegex(ValueError, 'Configuration must contain streams', load_collector, {'streams': {}})
+        self.assertRaisesRegex(ValueError, 'Missing backup of stream "a"', load_collector, {'streams': {'a': {'filename': 'a', 'time': '00:00'}}})
+        self.assertRaisesRegex(ValueError, 'Bad time "noon" of stream "a"', load_collector, {'streams': {'a': {'filename': 'a', 'backup': 'b', 'time': 'noon'}}})
+        self.assertRaisesRegex(ValueError, 'Missing fifo of stream "a" and socket of collector', load_collector, {'streams': {'a': {'filename': 'a', 'backup': 'b', 'time': '00:00'}}})
+        self.assertRaisesRegex(ValueError, 'Stream "a" cannot use both preallocate and stream_compress', load_collector, {
+            'socket': 's',
+            'streams': {'a': {'filename': 'a', 'backup': 'b', 'time': '00:00', 'preallocate': True, 'stream_compress': 'builtin:gzip'}}
+        })
+
+    def test_collector(self):
+        """Test lines of socket connections and FIFO are written to their streams"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            collector = load_collector({
+                'socket': os.path.join(sandbox, 'collector.sock'),
+                'defaults': {'time': '00:00'},
+                'streams': {
+                    'a': {'filename': os.path.join(sandbox, 'a.log'), 'backup': 'a-%H.log', 'fifo': os.path.join(sandbox, 'a.fifo')},
+                    'b': {'filename': os.path.join(sandbox, 'b.log'), 'backup': os.path.join(sandbox, 'b-%H%M%S%f.log'), 'size': 1},
+                }
+            })
+            with self.assertLogs() as logger:
+                collector.open()
+                try:
+                    with open(os.path.join(sandbox, 'a.fifo'), 'wb', 0) as fifo:
+                        fifo.write(b'fifo1\nfifo')
+                        clients = [socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) for _ in range(3)]
+                        for client in clients:
+                            client.connect(os.path.join(sandbox, 'collector.sock'))
+                        clients[0].sendall(b'b\nfirst\nsec')
+                        clients[1].sendall(b'unknown\nline\n')
+                        sender = threading.Thread(target=clients[2].sendall, args=(b'b\n' + b'x' * 1024 * 1024 + b'\n',))
+                        sender.start()
+                        for _ in range(50):
+                            collector.step(0.01)
+                        sender.join()
+                        fifo.write(b'2\n')
+                        clients[0].sendall(b'ond')
+                        for client in clients:
+                            client.close()
+                        for _ in range(50):
+                            collector.step(0.01)
+                finally:
+                    collector.close()
+            self.assertEqual(logger.output, ['WARNING:root:Unknown stream "unknown"'])
+            self.assertEqual(Path(sandbox, 'a.log').read_bytes(), b'fifo1\nfifo2\n')
+            backups = list(Path(sandbox).glob('b-*.log'))
+            self.assertEqual(len(backups), 1)
+            self.assertEqual(sorted((backups[0].read_bytes() + Path(sandbox, 'b.log').read_bytes()).splitlines()), [b'first', b'second', b'x' * 1024 * 1024])
+            self.assertFalse(Path(sandbox, 'collector.sock').exists())
+
+    def test_collector_rotates_on_lines(self):
+        """Test collector rotates right after the line reaching max_size, also within one read chunk"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            stream = Stream('c', self.create_state(sandbox, max_size=10))
+            collector = Collector([stream])
+            read_fd, write_fd = os.pipe()
+            try:
+                connection = Connection(stream)
+                for part in (b'aaaa\nbb', b'bb\ncc\ndddddddddddd\ne\nf'):
+                    os.write(write_fd, part)
+                    collector.read(read_fd, connection)
+                self.assertEqual(connection.partial, [b'f'])
+            finally:
+                os.close(read_fd)
+                os.close(write_fd)
+                stream.state.close()
+            backups = sorted(Path(sandbox, 'backup').iterdir())
+            self.assertEqual([backup.read_bytes() for backup in backups], [b'aaaa\nbbbb\n', b'cc\ndddddddddddd\n'])
+            self.assertEqual(Path(sandbox, 'live.log').read_bytes(), b'e\n')
+
+    def test_preallocate(self):
+        """Test live log is preallocated, continued after unclean exit and trimmed at rotation"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            live = Path(sandbox, 'live.log')
+            state = self.create_state(sandbox, max_size=100000, preallocate=True, drop_cache=True, backup_mask='live-%H.log')
+            state.write(b'first\n')
+            self.assertEqual(live.stat().st_size, 100000)
+            state.output.close()
+            state = self.create_state(sandbox, max_size=100000, preallocate=True, drop_cache=True, backup_mask='live-%H.log')
+            self.assertEqual(state.size, 6)
+            state.write(b'second\n')
+            with mock.patch('os.posix_fadvise') as fadvise:
+                rotate(state, datetime.datetime(year=2020, month=1, day=1, hour=12))
+            fadvise.assert_called_once_with(mock.ANY, 0, 0, os.POSIX_FADV_DONTNEED)
+            self.assertEqual(Path(sandbox, 'backup', 'live-12.log').read_bytes(), b'first\nsecond\n')
+            self.assertEqual(live.stat().st_size, 100000)
+            state.close()
+            self.assertEqual(live.read_bytes(), b'')
+
+    def test_preallocate_keeps_data_zeros_after_clean_close(self):
+        """Test zeros ending the data of a trimmed live log are kept when it is opened again"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            live = Path(sandbox, 'live.log')
+            state = self.create_state(sandbox, max_size=100000, preallocate=True)
+            state.write(b'data\0\0')
+            state.close()
+            self.assertEqual(live.read_bytes(), b'data\0\0')
+            state = self.create_state(sandbox, max_size=100000, preallocate=True)
+            self.assertEqual(state.size, 6)
+            state.write(b'more\n')
+            state.close()
+            self.assertEqual(live.read_bytes(), b'data\0\0more\n')
+
+    def test_stream_compression_restart(self):
+        """Test compressed live log stays readable when it is continued after a clean exit"""
+        with tempfile.TemporaryDirectory() as sandbox:
+            for line in (b'first\n', b'second\n'):
+                state = self.create_state(sandbox, max_size=100000, stream_compressor='builtin:gzip:6:1')
+                state.write(line)
+                state.close()
+            self.assertEqual(gzip.decompress(Path(sandbox, 'live.log').read_bytes()), b'first\nsecond\n')
+
+    def test_script_flushes_on_sigterm(self):
+        """Test buffered data are written out when stdout2log is terminated"""
+        script = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'stdout2log')
+        with tempfile.TemporaryDirectory() as sandbox:
+            live = os.path.join(sandbox, 'live.log')
+            proc = subprocess.Popen(
+                [sys.executable, script, '-t', '00:00', '-b', os.path.join(sandbox, '%Y.log'), '-B', '256', '-d', '5000', live],
+                stdin=subprocess.PIPE
+            )
+            try:
+                proc.stdin.write(b'line\n' * 10)
+                proc.stdin.flush()
+                while not os.path.exists(live):
+                    time.sleep(0.01)
+                time.sleep(0.2)
+                self.assertEqual(Path(live).read_bytes(), b'')
+                proc.send_signal(signal.SIGTERM)
+                self.assertEqual(proc.wait(10), 0)
+            finally:
+                proc.stdin.close()
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+            self.assertEqual(Path(live).read_bytes(), b'line\n' * 10)
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""In-process block compression to gzip, bzip2 and xz"""
+
+import os
+import bz2
+import gzip
+import lzma
+import shutil
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+BUILTIN_PREFIX = 'builtin:'
+
+BLOCK_SIZE = 8 * 1024 * 1024
+
+# extension, default level, compress function and the lowest level accepted by the format, the highest one is 9
+FORMATS = {
+    'gzip': ('.gz', 6, lambda data, level: gzip.compress(data, compresslevel=level), 0),
+    'bzip2': ('.bz2', 9, lambda data, level: bz2.compress(data, compresslevel=level), 1),
+    'xz': ('.xz', 6, lambda data, level: lzma.compress(data, format=lzma.FORMAT_XZ, preset=level), 0),
+}
+FORMATS['gz'] = FORMATS['gzip']
+FORMATS['bz2'] = FORMATS['bzip2']
+
+def is_builtin(compressor):
+    """Check if compress option selects builtin backend"""
+    return str(compressor).startswith(BUILTIN_PREFIX)
+
+def parse_builtin(compressor):
+    """Parse "builtin:format[:level[:threads]]" to format, level and threads"""
+    parts = compressor[len(BUILTIN_PREFIX):].split(':')
+    if parts[0] not in FORMATS or len(parts) > 3:
+        raise ValueError('Bad builtin compressor "{}", use builtin:{{gzip|bzip2|xz}}[:level[:threads]].'.format(compressor))
+    try:
+        level = int(parts[1]) if len(parts) > 1 and parts[1] else FORMATS[parts[0]][1]
+        threads = int(parts[2]) if len(parts) > 2 else os.cpu_count() or 1
+    except ValueError:
+        raise ValueError('Bad level or threads in builtin compressor "{}".'.format(compressor))
+    if not FORMATS[parts[0]][3] <= level <= 9 or threads < 1:
+        raise ValueError('Bad level or threads in builtin compressor "{}".'.format(compressor))
+    return parts[0], level, threads
+
+def compress_file(filename, fmt, level, threads, block_size=BLOCK_SIZE):
+    """Compress file to concatenated independent streams, then remove it like gzip does"""
+    target = filename + FORMATS[fmt][0]
+    with open(filename, 'rb') as source, open(target, 'xb') as output:
+        try:
+            compress_stream(source, output, fmt, level, threads, block_size)
+            output.flush()
+            os.fsync(output.fileno())
+        except BaseException:
+            output.close()
+            os.remove(target)
+            raise
+    shutil.copystat(filename, target)
+    os.remove(filename)
+    return target
+
+def compress_stream(source, output, fmt, level, threads, block_size=BLOCK_SIZE):
+    """Read source by blocks and write each block compressed as an independent stream"""
+    compress = FORMATS[fmt][2]
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        in_flight = collections.deque()
+        while True:
+            data = source.read(block_size)
+            if data:
+                in_flight.append(executor.submit(compress, data, level))
+            # only a bounded number of blocks is kept in memory
+            while in_flight and (len(in_flight) > threads or not data):
+                output.write(in_flight.popleft().result())
+            if not data:
+                break
+
+class BuiltinCompressor(threading.Thread):
+    """Builtin compression running in background with Popen-like poll and returncode"""
+    def __init__(self, compressor, filename, cwd):
+        super().__init__(daemon=True)
+        self.fmt, self.level, self.threads = parse_builtin(compressor)
+        self.filename = os.path.join(cwd, filename)
+        self.returncode = None
+
+    def run(self):
+        try:
+            compress_file(self.filename, self.fmt, self.level, self.threads)
+            self.returncode = 0
+        except Exception as exception: # pylint: disable=broad-except
+            logging.exception(exception)
+            self.returncode = 1
+
+    def poll(self):
+        """Return exit code or None while running"""
+        return None if self.is_alive() else self.returncode
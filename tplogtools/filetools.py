@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+"""Moving and copying files without userspace buffers"""
+
+import os
+import time
+import errno
+import fcntl
+import shutil
+import collections
+from tplogtools.compresstools import FORMATS, compress_stream
+
+COPY_CHUNK = 64 * 1024 * 1024
+
+FICLONE = 0x40049409
+
+UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP)
+
+def move_file(source, target, compressor=None):
+    """Rename file, copy it by kernel to other filesystem when rename is not possible
+
+    With compressor given as (format, level, threads) the cross-device copy is
+    compressed on the fly and the path of the compressed target is returned.
+    """
+    try:
+        os.rename(source, target)
+        return target
+    except OSError as exception:
+        if exception.errno != errno.EXDEV:
+            raise
+    if compressor:
+        fmt, level, threads = compressor
+        target += FORMATS[fmt][0]
+    with open(source, 'rb') as src, open(target, 'xb') as dst:
+        try:
+            if compressor:
+                compress_stream(src, dst, fmt, level, threads)
+                dst.flush()
+                copied = src.tell()
+            else:
+                copied = copy_fd(src.fileno(), dst.fileno())
+                # a kernel copy may end early, the rest is copied again
+                missing = os.fstat(src.fileno()).st_size - copied
+                while missing > 0:
+                    more = copy_fd(src.fileno(), dst.fileno(), missing, copied)
+                    if not more:
+                        break
+                    copied += more
+                    missing = os.fstat(src.fileno()).st_size - copied
+            size = os.fstat(src.fileno()).st_size
+            if copied != size:
+                raise OSError(errno.EIO, 'Copied {} of {} bytes'.format(copied, size), source)
+            os.fsync(dst.fileno())
+        except BaseException:
+            dst.close()
+            os.remove(target)
+            raise
+    copy_metadata(source, target)
+    os.remove(source)
+    return target
+
+def copy_fd(src_fd, dst_fd, size=None, offset=0):
+    """Copy size bytes or up to the end from offset by kernel, plain read and write is the last resort"""
+    copied = 0
+    for method in ('copy_file_range', 'ficlone', 'sendfile'):
+        if method == 'ficlone':
+            if offset or size is not None or not clone_fd(src_fd, dst_fd):
+                continue
+            return os.fstat(dst_fd).st_size
+        if not hasattr(os, method):
+            continue
+        try:
+            if method == 'sendfile':
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+            while size is None or copied < size:
+                count = COPY_CHUNK if size is None else min(COPY_CHUNK, size - copied)
+                if method == 'sendfile':
+                    sent = os.sendfile(dst_fd, src_fd, offset + copied, count)
+                else:
+                    sent = os.copy_file_range(src_fd, dst_fd, count, offset + copied, offset + copied)
+                if sent == 0:
+                    break
+                copied += sent
+            return copied
+        except OSError as exception:
+            if copied or exception.errno not in UNSUPPORTED:
+                raise
+    os.lseek(src_fd, offset, os.SEEK_SET)
+    os.lseek(dst_fd, offset, os.SEEK_SET)
+    while size is None or copied < size:
+        data = os.read(src_fd, 1024 * 1024 if size is None else min(1024 * 1024, size - copied))
+        if not data:
+            break
+        while data:
+            written = os.write(dst_fd, data)
+            copied += written
+            data = data[written:]
+    return copied
+
+def clone_fd(src_fd, dst_fd):
+    """Share all extents of source with target by reflink, return False where not supported"""
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError as exception:
+        if exception.errno not in UNSUPPORTED + (errno.ENOTTY,):
+            raise
+        return False
+
+CopyTruncateStats = collections.namedtuple('CopyTruncateStats', ('copied', 'seconds', 'lost', 'window'))
+
+def copy_truncate(source, target, passes=3):
+    """Snapshot content of live file to target and truncate it
+
+    Writes made during the copy are caught up in next passes, bytes written
+    after the last pass till the truncation are lost and they are reported.
+    """
+    start = time.monotonic()
+    with open(source, 'r+b') as src, open(target, 'xb') as dst:
+        try:
+            copied = copy_fd(src.fileno(), dst.fileno())
+            for _ in range(passes):
+                size = os.fstat(src.fileno()).st_size
+                if size <= copied:
+                    break
+                copied += copy_fd(src.fileno(), dst.fileno(), size - copied, copied)
+            window_start = time.monotonic()
+            lost = max(0, os.fstat(src.fileno()).st_size - copied)
+            os.ftruncate(src.fileno(), 0)
+            window = time.monotonic() - window_start
+            os.fsync(dst.fileno())
+        except BaseException:
+            dst.close()
+            os.remove(target)
+            raise
+    copy_metadata(source, target)
+    return CopyTruncateStats(copied, time.monotonic() - start, lost, window)
+
+def copy_metadata(source, target):
+    """Copy permissions, times, xattrs and if allowed also the owner"""
+    shutil.copystat(source, target)
+    stats = os.stat(source)
+    try:
+        os.chown(target, stats.st_uid, stats.st_gid)
+    except PermissionError:
+        pass
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""Minimal inotify binding over ctypes"""
+
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = getattr(os, 'O_CLOEXEC', 0o2000000)
+
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """Inotify instance with watches identified by watch descriptors"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.inotify_add_watch = libc.inotify_add_watch
+        self.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.inotify_rm_watch = libc.inotify_rm_watch
+        self.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise_errno()
+
+    def add_watch(self, path, mask):
+        """Watch given path, return watch descriptor"""
+        wd = self.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise_errno(path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching by watch descriptor"""
+        if self.inotify_rm_watch(self.fd, wd) < 0:
+            raise_errno()
+
+    def read_events(self, timeout=None):
+        """Wait up to timeout seconds and return list of (wd, mask, cookie, name)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        return parse_events(data)
+
+    def close(self):
+        """Close inotify instance with all its watches"""
+        os.close(self.fd)
+
+def parse_events(data):
+    """Split raw buffer read from inotify to list of (wd, mask, cookie, name)"""
+    events = []
+    offset = 0
+    while offset < len(data):
+        wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+        offset += EVENT_HEADER.size
+        name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+        offset += length
+        events.append((wd, mask, cookie, name))
+    return events
+
+def raise_errno(filename=None):
+    """Raise OSError from current errno"""
+    err = ctypes.get_errno() or errno.EINVAL
+    raise OSError(err, os.strerror(err), filename)
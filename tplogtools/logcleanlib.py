@@ -0,0 +1,513 @@
+#!/usr/bin/env python3
+"""Unit-tested functions for logclean"""
+
+import os
+import sys
+import math
+import heapq
+import collections
+import marshal
+import sqlite3
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from tplogtools import inotify
+
+class File:
+    """Log file statistics"""
+    __slots__ = ('name', 'group_id', 'blocks', 'age')
+
+    def __init__(self, name, group_id, blocks, age):
+        self.name = name
+        self.group_id = group_id
+        self.blocks = blocks
+        self.age = age
+
+class Device:
+    """Collection of log files on some device"""
+    def __init__(self, block_size, to_free):
+        self.block_size = block_size
+        self.to_free = to_free
+        self.files = {}
+        self.group_counters = {}
+
+    def add_file(self, f):
+        self.files[f.name] = f
+
+    def remove_file(self, name):
+        """Forget file by its name, return False for unknown file"""
+        f = self.files.pop(name, None)
+        if f is None:
+            return False
+        self.group_counters[f.group_id] -= 1
+        return True
+
+    def inc_group_counter(self, group_id):
+        if group_id in self.group_counters:
+            self.group_counters[group_id] += 1
+        else:
+            self.group_counters[group_id] = 1
+
+    def get_files_to_remove(self, min_files_per_group, min_file_age, max_file_age):
+        """Return overaged files and then the oldest files needed to free space, both oldest first"""
+        to_free = self.to_free
+        overaged_age = max(min_file_age, max_file_age)
+        overaged = []
+        candidates = []
+        for index, f in enumerate(self.files.values()):
+            if f.age > min_file_age and self.group_counters[f.group_id] > min_files_per_group:
+                if f.age > overaged_age:
+                    overaged.append(f)
+                else:
+                    candidates.append((-f.age, index, f))
+        to_remove = sorted(overaged, key=lambda x: -x.age)
+        for f in to_remove:
+            to_free -= f.blocks
+            print("Overaged file: %s" % f.name)
+        heapq.heapify(candidates)
+        while to_free > 0 and candidates:
+            f = heapq.heappop(candidates)[2]
+            to_remove.append(f)
+            to_free -= f.blocks
+            print("Freeing up space: %s" % f.name)
+        if to_free > 0:
+            sys.stderr.write("\nUnable to free enough space on device %s (%.2f MB excess)!\n" % (os.path.dirname(next(iter(self.files))), float(to_free) * self.block_size / 1024 / 1024))
+        return to_remove
+
+class GroupIndex:
+    """Interned mapping of group names to dense integer ids"""
+    def __init__(self):
+        self.ids = {}
+
+    def get_id(self, group):
+        """Return id of given group, assign the next free one for unknown group"""
+        return self.ids.setdefault(group, len(self.ids))
+
+    def __len__(self):
+        return len(self.ids)
+
+class Collector:
+    """Scanner sorting files of given paths to devices by st_dev"""
+    def __init__(self, r_group, min_free_space_on_device, now, recursive=False, cache=None, dir_callback=None):
+        self.r_group = r_group
+        self.min_free_space_on_device = min_free_space_on_device
+        self.now = now
+        self.recursive = recursive
+        self.cache = cache
+        self.dir_callback = dir_callback
+        self.groups = GroupIndex()
+        self.devices = {}
+
+    def add_path(self, path):
+        """Add a file or all files from a directory"""
+        for dirname, name, stats in self.list_path(path):
+            self.add_file(dirname, name, stats)
+
+    def scan_dir(self, path):
+        """Add all files from directory"""
+        for dirname, name, stats in self.list_tree(path):
+            self.add_file(dirname, name, stats)
+
+    def list_path(self, path):
+        """Return directory, name and stats of a file or of all files from a directory"""
+        if os.path.isfile(path):
+            return [(os.path.dirname(path), os.path.basename(path), os.stat(path))]
+        return self.list_tree(path)
+
+    def list_tree(self, path):
+        """List directory, stats are taken from cached DirEntry or scan cache"""
+        files = []
+        dir_stack = [path]
+        while dir_stack:
+            dirname = dir_stack.pop()
+            if self.dir_callback:
+                self.dir_callback(dirname)
+            entries = self.cache.list_dir(dirname) if self.cache else list_dir(dirname)
+            for name, is_dir, stats in entries:
+                if self.recursive and is_dir:
+                    dir_stack.append(os.path.join(dirname, name))
+                else:
+                    files.append((dirname, name, stats))
+        return files
+
+    def add_file(self, path, filename, stats):
+        """Add one file with known stats to its device"""
+        m_group = self.r_group.match(filename)
+        group_id = self.groups.get_id(os.path.join(path, m_group.group('group') if m_group else filename))
+        fullname = os.path.join(path, filename)
+        device = self.devices.get(stats.st_dev)
+        if device is None:
+            device = self.devices[stats.st_dev] = get_device_info(fullname, self.min_free_space_on_device)
+        elif fullname in device.files:
+            return
+        device.inc_group_counter(group_id)
+        device.add_file(File(fullname, group_id, math.ceil(float(stats.st_size)/device.block_size), (self.now-stats.st_mtime)/60/60/24))
+
+def collect_files(path_stack, r_group, min_free_space_on_device, now, recursive=False, cache=None, jobs=1):
+    """Scan given paths and return files sorted to devices by st_dev"""
+    collector = Collector(r_group, min_free_space_on_device, now, recursive, cache)
+    path_stack = list(path_stack)
+    if jobs > 1 and len(path_stack) > 1:
+        listings = list_paths_by_device(collector, path_stack, jobs)
+    else:
+        listings = map(collector.list_path, path_stack)
+    # files are added in the order of paths so the result does not depend on jobs
+    for listing in listings:
+        for dirname, name, stats in listing:
+            collector.add_file(dirname, name, stats)
+    return collector.devices
+
+def list_paths_by_device(collector, path_stack, jobs):
+    """List paths concurrently, each device has its own pool of jobs workers"""
+    by_device = {}
+    for path in path_stack:
+        try:
+            st_dev = os.stat(path).st_dev
+        except OSError:
+            st_dev = None
+        by_device.setdefault(st_dev, []).append(path)
+    executors = [ThreadPoolExecutor(max_workers=min(jobs, len(paths))) for paths in by_device.values()]
+    try:
+        futures = {}
+        for executor, paths in zip(executors, by_device.values()):
+            for path in paths:
+                futures[path] = executor.submit(collector.list_path, path)
+        return [futures[path].result() for path in path_stack]
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True)
+
+def list_dir(dirname):
+    """Return name, directory flag and stats of every directory entry"""
+    with os.scandir(dirname) as entries:
+        return [(entry.name, entry.is_dir(follow_symlinks=False), entry.stat()) for entry in entries]
+
+RACY_SECONDS = 2
+
+def is_listing_stable(dir_stat):
+    """Return True when listing of directory can be reused while its mtime is unchanged,
+    directory changed in the same mtime tick as it was listed could be served stale"""
+    return time.time() - dir_stat.st_mtime >= RACY_SECONDS
+
+def stat_entry(dirname, name):
+    """Return stats of directory entry, None when it disappeared"""
+    try:
+        return os.stat(os.path.join(dirname, name))
+    except FileNotFoundError:
+        return None
+
+CachedStat = collections.namedtuple('CachedStat', ('st_dev', 'st_size', 'st_mtime'))
+
+class ScanCache:
+    """Persistent directory listings valid while directory mtime is unchanged,
+    stats of files not modified for SETTLE_SECONDS are reused too, the others are read again"""
+    VERSION = 3
+    SETTLE_SECONDS = 86400
+
+    def __init__(self, filename, rebuild=False):
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.lock = threading.Lock()
+        if rebuild or self.db.execute('PRAGMA user_version').fetchone()[0] != self.VERSION:
+            self.db.execute('DROP TABLE IF EXISTS dirs')
+            self.db.execute('DROP TABLE IF EXISTS files')
+            self.db.execute('PRAGMA user_version = %d' % self.VERSION)
+        # one marshalled blob per directory loads much faster than a row per file
+        self.db.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, dev INTEGER, ino INTEGER, mtime_ns INTEGER, entries BLOB)')
+        self.hits = 0
+        self.misses = 0
+        self.restats = 0
+
+    def list_dir(self, dirname):
+        """Same as list_dir, entries are served from cache if directory was not changed since it was stored"""
+        key = os.path.abspath(dirname)
+        dir_stat = os.stat(dirname)
+        version = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+        with self.lock:
+            row = self.db.execute('SELECT dev, ino, mtime_ns, entries FROM dirs WHERE path = ?', (key,)).fetchone()
+            if row and row[:3] == version:
+                self.hits += 1
+            else:
+                row = None
+                self.misses += 1
+        if row:
+            return self.revalidate(dirname, key, marshal.loads(row[3]))
+        entries = list_dir(dirname)
+        with self.lock:
+            self.db.execute('DELETE FROM dirs WHERE path = ?', (key,))
+            if is_listing_stable(dir_stat):
+                self.db.execute('INSERT INTO dirs VALUES (?, ?, ?, ?, ?)', (key,) + version + (marshal.dumps([
+                    (name, is_dir, stats.st_dev, stats.st_size, stats.st_mtime) for name, is_dir, stats in entries
+                ]),))
+        return entries
+
+    def revalidate(self, dirname, key, rows):
+        """Return cached entries, appending to a file does not change mtime of its directory,
+        so stats of files modified within SETTLE_SECONDS before they were stored are read again"""
+        settled = time.time() - self.SETTLE_SECONDS
+        entries = []
+        stored = []
+        changed = False
+        for row in rows:
+            name, is_dir, dev, size, mtime = row
+            if mtime < settled:
+                entries.append((name, is_dir, CachedStat(dev, size, mtime)))
+                stored.append(row)
+                continue
+            self.restats += 1
+            changed = True
+            stats = stat_entry(dirname, name)
+            if stats is not None:
+                entries.append((name, is_dir, stats))
+                stored.append((name, is_dir, stats.st_dev, stats.st_size, stats.st_mtime))
+        if changed:
+            with self.lock:
+                self.db.execute('UPDATE dirs SET entries = ? WHERE path = ?', (marshal.dumps(stored), key))
+        return entries
+
+    def close(self):
+        """Store changes and close the cache file"""
+        self.db.commit()
+        self.db.close()
+
+def recheck_files(files, now):
+    """Return files whose age still holds by their current stats, files modified after they were cached are kept"""
+    rechecked = []
+    for f in files:
+        try:
+            age = (now - os.stat(f.name).st_mtime)/60/60/24
+        except FileNotFoundError:
+            continue
+        if age >= f.age - 1.0/60/60/24:
+            rechecked.append(f)
+        else:
+            sys.stderr.write("File '%s' was modified since it was cached, it is kept!\n" % f.name)
+    return rechecked
+
+def remove_files(files, jobs):
+    """Remove files directory by directory in a thread pool, return count and blocks of removed files"""
+    by_dir = {}
+    for f in files:
+        dirname, basename = os.path.split(f.name)
+        by_dir.setdefault(dirname, []).append((basename, f))
+    removed = 0
+    blocks = 0
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for dir_removed, dir_blocks in executor.map(remove_dir_files, by_dir.keys(), by_dir.values()):
+            removed += dir_removed
+            blocks += dir_blocks
+    return removed, blocks
+
+def remove_dir_files(dirname, entries):
+    """Unlink files relative to once opened directory"""
+    removed = 0
+    blocks = 0
+    dir_fd = None
+    if os.unlink in os.supports_dir_fd:
+        try:
+            dir_fd = os.open(dirname or '.', os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+        except OSError:
+            pass
+    try:
+        for basename, f in entries:
+            try:
+                if dir_fd is None:
+                    os.remove(f.name)
+                else:
+                    os.unlink(basename, dir_fd=dir_fd)
+            except OSError:
+                sys.stderr.write("Can't delete file '%s'!\n" % f.name)
+            else:
+                removed += 1
+                blocks += f.blocks
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+    return removed, blocks
+
+def remove_device_files(device, files, jobs):
+    """Remove planned files of the device and report amount, size and duration"""
+    start = time.monotonic()
+    removed, blocks = remove_files(files, jobs)
+    print("Removed %d files (%.2f MB) from device %s in %.2f s" % (
+        removed,
+        float(blocks) * device.block_size / 1024 / 1024,
+        os.path.dirname(files[0].name),
+        time.monotonic() - start
+    ))
+    return removed
+
+def get_device_info(file_on_device, min_free_space_on_device):
+    """Create Device with empty file list"""
+    return Device(*get_space_to_free(file_on_device, min_free_space_on_device))
+
+def get_space_to_free(file_on_device, min_free_space_on_device):
+    """Return block size and number of blocks missing to the required free space"""
+    stat = os.statvfs(file_on_device)
+    need_free = min_free_space_on_device * stat.f_blocks / 100
+    to_free = need_free - stat.f_bavail
+    return stat.f_frsize, to_free
+
+WATCH_MASK = inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO \
+    | inotify.IN_CLOSE_WRITE | inotify.IN_MODIFY | inotify.IN_ATTRIB | inotify.IN_ONLYDIR
+
+class Watcher:
+    """Files of given paths kept in memory by inotify, removed as soon as limits are crossed"""
+    def __init__(self, path_stack, r_group, config):
+        self.path_stack = path_stack
+        self.r_group = r_group
+        self.config = config
+        self.inotify = inotify.Inotify()
+        self.watches = {}
+        self.watched_dirs = set()
+        self.device_dirs = {}
+        self.collector = None
+        self.pending = set()
+        self.over_limit = set()
+        self.protected = set()
+        self.next_expiry = 0
+
+    def run(self):
+        """Scan paths and then follow changes until interrupted"""
+        self.scan()
+        next_poll = 0
+        while True:
+            events = self.inotify.read_events(max(0, next_poll - time.monotonic()))
+            if events:
+                self.process_events(events)
+            if time.monotonic() >= next_poll:
+                next_poll = time.monotonic() + self.config['poll-interval']
+                self.poll()
+
+    def scan(self):
+        """Build the model from scratch, all devices will be checked"""
+        self.collector = Collector(
+            self.r_group,
+            self.config['min-free-space-on-device'],
+            time.time(),
+            self.config['recursive'],
+            dir_callback=self.watch_dir
+        )
+        # names of files from events have to match those of the scan
+        for path in map(os.path.normpath, self.path_stack):
+            if os.path.isfile(path):
+                self.watch_dir(os.path.dirname(path) or '.', os.path.basename(path))
+            self.collector.add_path(path)
+        self.pending = set(self.collector.devices)
+        self.over_limit = set()
+
+    def watch_dir(self, dirname, name=None):
+        """Watch directory for all files or for one given name only"""
+        wd = self.inotify.add_watch(dirname, WATCH_MASK)
+        names = self.watches.get(wd, (dirname, set()))[1]
+        if names is not None:
+            names = {name} | names if name else None
+        self.watches[wd] = (dirname, names)
+        self.watched_dirs.add(dirname)
+        self.device_dirs.setdefault(os.stat(dirname).st_dev, dirname)
+
+    def process_events(self, events):
+        """Update the model by inotify events, every file is checked once per batch"""
+        changed = {}
+        for wd, mask, _cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                self.scan()
+                return
+            if mask & inotify.IN_IGNORED:
+                dirname, _names = self.watches.pop(wd, (None, None))
+                self.watched_dirs.discard(dirname)
+                continue
+            dirname, names = self.watches.get(wd, (None, set()))
+            if name and (names is None or name in names):
+                fullname = os.path.normpath(os.path.join(dirname, name))
+                changed[fullname] = (os.path.dirname(fullname), name, mask)
+        for fullname, (dirname, name, mask) in changed.items():
+            self.update_file(fullname, dirname, name, mask)
+
+    def update_file(self, fullname, dirname, name, mask):
+        """Replace file in the model by its current state"""
+        for device in self.collector.devices.values():
+            device.remove_file(fullname)
+        if mask & inotify.IN_ISDIR and mask & inotify.IN_MOVED_FROM:
+            self.forget_dir(fullname)
+        try:
+            stats = os.stat(fullname)
+        except OSError:
+            return
+        if self.collector.recursive and mask & inotify.IN_ISDIR:
+            if fullname not in self.watched_dirs:
+                self.collector.scan_dir(fullname)
+            return
+        known_devices = set(self.collector.devices)
+        self.collector.add_file(dirname, name, stats)
+        if stats.st_dev not in known_devices or stats.st_dev in self.over_limit or stats.st_dev in self.protected:
+            self.pending.add(stats.st_dev)
+        self.next_expiry = min(self.next_expiry, self.expiry_time(stats.st_mtime))
+
+    def forget_dir(self, dirname):
+        """Forget all files from moved away directory tree"""
+        prefix = os.path.join(dirname, '')
+        for device in self.collector.devices.values():
+            for name in [name for name in device.files if name.startswith(prefix)]:
+                device.remove_file(name)
+
+    def expiry_time(self, mtime):
+        """Return time when file with given mtime becomes overaged"""
+        return mtime + max(self.config['min-file-age'], self.config['max-file-age']) * 24 * 60 * 60
+
+    def poll(self):
+        """Check free space of devices and plan removal where some limit is crossed"""
+        now = time.time()
+        for st_dev, device in self.collector.devices.items():
+            if not device.files:
+                continue
+            device.block_size, device.to_free = get_space_to_free(
+                self.device_dirs.get(st_dev, next(iter(device.files))),
+                self.config['min-free-space-on-device']
+            )
+            if device.to_free <= 0:
+                self.over_limit.discard(st_dev)
+            elif st_dev not in self.over_limit:
+                self.over_limit.add(st_dev)
+                self.pending.add(st_dev)
+        if now >= self.next_expiry:
+            self.pending.update(self.collector.devices)
+        if self.pending:
+            for st_dev in self.pending:
+                self.clean_device(st_dev, now)
+            self.pending = set()
+            self.update_expiry(now)
+            sys.stdout.flush()
+
+    def clean_device(self, st_dev, now):
+        """Plan and remove files of one device"""
+        device = self.collector.devices.get(st_dev)
+        if device is None or not device.files:
+            return
+        # ages were computed against scan time, limits are shifted instead of all files
+        shift = (now - self.collector.now) / 60 / 60 / 24
+        to_remove = device.get_files_to_remove(
+            self.config['min-files-per-group'],
+            self.config['min-file-age'] - shift,
+            self.config['max-file-age'] - shift
+        )
+        if to_remove and not self.config['dry-run']:
+            remove_device_files(device, to_remove, self.config['delete-jobs'])
+        for f in to_remove:
+            device.remove_file(f.name)
+
+    def update_expiry(self, now):
+        """Find the next moment when some file becomes overaged"""
+        self.next_expiry = float('inf')
+        self.protected = set()
+        overaged_age = max(self.config['min-file-age'], self.config['max-file-age'])
+        for st_dev, device in self.collector.devices.items():
+            for f in device.files.values():
+                expiry = self.collector.now + (overaged_age - f.age) * 24 * 60 * 60
+                if expiry > now:
+                    self.next_expiry = min(self.next_expiry, expiry)
+                else:
+                    self.protected.add(st_dev)
+
+    def close(self):
+        """Stop watching"""
+        self.inotify.close()
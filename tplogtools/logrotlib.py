@@ -2,12 +2,25 @@
 """Unit-tested functions for logrot"""
 
 import os
-import stat
+import io
+import re
+import sys
+import types
 import fnmatch
+import functools
+import glob
 import logging
-import shutil
 import shlex
+import stat
 import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from tplogtools import inotify
+from tplogtools.compresstools import is_builtin, parse_builtin, BuiltinCompressor
+from tplogtools.filetools import move_file, copy_truncate
+from tplogtools.metrics import timed
+from tplogtools.timetools import local_tz_now
 
 def need_to_rotate_log(min_size, max_size, max_time_interval, log_size, time_interval):
     """Check if log match criteria for rotation"""
@@ -47,35 +60,128 @@ def unit_to_multiplier(unit, human):
         return base ** UNITS[norm_unit]
     raise ValueError('Bad unit "{}" in size parameter "{}".'.format(unit, human))
 
-class ChDir:
-    """Contextmanager for running code with specified path as cwd"""
-    def __init__(self, new_pwd):
-        self.new_pwd = new_pwd
-        self.old_pwd = None
+def parse_size(size):
+    """Return size in bytes from already parsed integer or from human units"""
+    return size if isinstance(size, int) else human_size_units_to_base(size)
+
+class RuleSet:
+    """Configuration compiled once, resolved configs are memoized by filename"""
+    SIZE_KEYS = ('min_size', 'max_size')
+    COMMAND_KEYS = ('exec_pre', 'exec_post', 'compress')
+    INTERVALS = (None, '', 'hourly', 'daily')
 
-    def __enter__(self):
-        self.old_pwd = os.getcwd()
-        os.chdir(self.new_pwd)
+    def __init__(self, conf):
+        conf = conf or {}
+        if not isinstance(conf, dict) or not isinstance(conf.get('defaults') or {}, dict):
+            raise ValueError('Configuration and its defaults must be mappings.')
+        self.defaults = self.compile_options(conf.get('defaults') or {}, 'defaults')
+        self.rules = []
+        all_masks = []
+        for index, spec_def in enumerate(conf.get('specific') or []):
+            if not isinstance(spec_def, dict):
+                raise ValueError('Specific rule {} must be a mapping.'.format(index + 1))
+            masks = spec_def.get('mask', [])
+            if not isinstance(masks, list) or not all(isinstance(mask, str) for mask in masks):
+                raise ValueError('Mask of specific rule {} must be a list of strings.'.format(index + 1))
+            options = self.compile_options(spec_def, 'specific rule {}'.format(index + 1))
+            self.rules.append((self.compile_masks(masks), options))
+            all_masks += masks
+        self.any_rule = self.compile_masks(all_masks)
+        self.get_config = functools.lru_cache(maxsize=64 * 1024)(self.resolve_config)
+
+    def compile_options(self, options, where):
+        """Check options and convert sizes to bytes"""
+        compiled = dict(options)
+        for key in self.SIZE_KEYS:
+            if key in compiled:
+                try:
+                    compiled[key] = parse_size(compiled[key])
+                except ValueError as exception:
+                    raise ValueError('Bad {} in {}: {}'.format(key, where, exception))
+        for key in self.COMMAND_KEYS:
+            try:
+                shlex.split(compiled.get(key) or '')
+            except ValueError as exception:
+                raise ValueError('Bad {} in {}: {}'.format(key, where, exception))
+        if is_builtin(compiled.get('compress', '')):
+            try:
+                parse_builtin(compiled['compress'])
+            except ValueError as exception:
+                raise ValueError('Bad compress in {}: {}'.format(where, exception))
+        if compiled.get('interval') not in self.INTERVALS:
+            raise ValueError('Bad interval "{}" in {}.'.format(compiled.get('interval'), where))
+        return compiled
 
-    def __exit__(self, *args):
-        os.chdir(self.old_pwd)
+    @staticmethod
+    def compile_masks(masks):
+        """Combine shell masks to one precompiled regex"""
+        if not masks:
+            return None
+        return re.compile('|'.join('(?:{})'.format(fnmatch.translate(os.path.normcase(mask))) for mask in masks))
 
-def process_path(now, conf, interval, path):
-    """Process all files on given path"""
+    def resolve_config(self, filename):
+        """Return immutable configuration specific for given filename"""
+        spec_config = self.defaults.copy()
+        normalized = os.path.normcase(filename)
+        if self.any_rule is not None and self.any_rule.match(normalized):
+            for masks, options in self.rules:
+                if masks is not None and masks.match(normalized):
+                    spec_config.update(options)
+        return types.MappingProxyType(spec_config)
+
+def process_path(now, conf, interval, path, out=None, metrics=None, snapshot=None):
+    """Process all files on given path, listing of the path is taken from snapshot when given"""
+    rules = conf if isinstance(conf, RuleSet) else RuleSet(conf)
     compressors = []
-    for filename in os.listdir(path):
-        fullname = os.path.join(path, filename)
-        filestat = os.stat(fullname, follow_symlinks=False)
-        if stat.S_ISREG(filestat.st_mode):
-            compressors += process_log(
-                now,
-                get_spec_config(conf, filename),
-                interval,
-                fullname,
-                filestat.st_size
-            )
+    with timed(metrics, 'scan'):
+        logs = snapshot.list_files(path) if snapshot else list_logs(path)
+    batches = {}
+    for fullname, filename, filestat in logs:
+        spec_config = rules.get_config(filename)
+        if spec_config.get('exec_batch', False) and (spec_config.get('exec_pre') or spec_config.get('exec_post')):
+            batches.setdefault((spec_config.get('exec_pre', ''), spec_config.get('exec_post', '')), []).append((fullname, spec_config, filestat.st_size))
+            continue
+        compressors += process_log(
+            now,
+            spec_config,
+            interval,
+            fullname,
+            filestat.st_size,
+            out,
+            metrics
+        )
+    for logs_batch in batches.values():
+        compressors += process_log_batch(now, interval, logs_batch, out, metrics)
     return compressors
 
+def list_logs(path):
+    """Return full name, name and stats of regular files on given path"""
+    with os.scandir(path) as entries:
+        return [(entry.path, entry.name, entry.stat(follow_symlinks=False)) for entry in entries if entry.is_file(follow_symlinks=False)]
+
+def process_paths(now, conf, interval, paths, jobs=1, metrics=None, snapshot=None):
+    """Process paths by a pool of jobs workers, output and compressors are kept in the order of paths"""
+    rules = conf if isinstance(conf, RuleSet) else RuleSet(conf)
+    if jobs <= 1:
+        return [compressor for path in paths for compressor in process_isolated_path(now, rules, interval, path, None, metrics, snapshot)]
+    compressors = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        outputs = [io.StringIO() for _ in paths]
+        futures = [executor.submit(process_isolated_path, now, rules, interval, path, out, metrics, snapshot) for path, out in zip(paths, outputs)]
+        for future, out in zip(futures, outputs):
+            compressors += future.result()
+            sys.stdout.write(out.getvalue())
+            sys.stdout.flush()
+    return compressors
+
+def process_isolated_path(now, rules, interval, path, out=None, metrics=None, snapshot=None):
+    """Process path, failure of the path is logged and does not affect other paths"""
+    try:
+        return process_path(now, rules, interval, path, out, metrics, snapshot)
+    except OSError as exception:
+        logging.error('Processing of path "%s" failed: %s', path, exception)
+        return []
+
 def get_spec_config(conf, filename):
     """Return configuration specific for given filename"""
     spec_config = conf.get('defaults', {}).copy()
@@ -91,51 +197,168 @@ def name_match_masks(filename, masks):
             return True
     return False
 
-def process_log(now, spec_config, interval, fullname, filesize):
-    """Process one given file"""
+def process_log(now, spec_config, interval, fullname, filesize, out=None, metrics=None):
+    """Process one given file, progress is printed to out or to stdout"""
     if spec_config.get('ignore', False):
         return []
-    compressors = []
-    print('Checking "{}"...'.format(fullname), end=' ', flush=True)
-    if need_to_rotate_log(
-                human_size_units_to_base(spec_config.get('min_size', '0')),
-                human_size_units_to_base(spec_config.get('max_size', '2T')),
-                spec_config.get('interval', None),
-                filesize,
-                interval
-        ):
+    start = time.monotonic()
+    compressors, outcome = rotate_log(now, spec_config, interval, fullname, filesize, out, metrics)
+    if metrics:
+        metrics.add_file(fullname, outcome, filesize, time.monotonic() - start)
+    return compressors
+
+def rotate_log(now, spec_config, interval, fullname, filesize, out=None, metrics=None):
+    """Rotate one file if needed, return its compressors and outcome"""
+    print('Checking "{}"...'.format(fullname), end=' ', flush=True, file=out)
+    if not need_to_rotate(spec_config, interval, filesize):
+        print('rotation not needed.', flush=True, file=out)
+        return [], 'not_needed'
+    path, filename = os.path.split(fullname)
+    target = compose_target(now, path, filename, spec_config.get('target', ''))
+    exec_pre = spec_config.get('exec_pre', '')
+    if exec_pre:
+        with timed(metrics, 'exec_pre'):
+            if not run_pre(exec_pre, filename, path, out):
+                return [], 'exec_pre_failed'
+    if not target:
+        print('missing target in configuration.', flush=True, file=out)
+        return [], 'missing_target'
+    print('rotating...', end=' ', flush=True, file=out)
+    try:
+        os.makedirs(os.path.dirname(os.path.join(path, target)), exist_ok=True)
+        print('"{}" -> "{}"'.format(fullname, target), end=' ', flush=True, file=out)
+        with timed(metrics, 'move'):
+            moved_target = move_log(fullname, target, spec_config)
+        if moved_target is None:
+            print('target already exists!', flush=True, file=out)
+            return [], 'target_exists'
+        exec_post = spec_config.get('exec_post', '')
+        if exec_post:
+            with timed(metrics, 'exec_post'):
+                if not run_post(exec_post, moved_target, path, out):
+                    return [], 'exec_post_failed'
+        print('done.', flush=True, file=out)
+        return get_compressors(path, target, moved_target, spec_config), 'rotated'
+    except OSError as exception:
+        logging.exception(exception)
+        return [], 'error'
+
+def process_log_batch(now, interval, logs, out=None, metrics=None):
+    """Process logs of one path sharing exec_pre and exec_post, each hook runs once with all files"""
+    def add_file(fullname, outcome, filesize, seconds=0.0):
+        if metrics:
+            metrics.add_file(fullname, outcome, filesize, seconds)
+    to_rotate = []
+    for fullname, spec_config, filesize in sorted(logs, key=lambda log: log[0]):
+        if spec_config.get('ignore', False):
+            continue
         path, filename = os.path.split(fullname)
-        target = compose_target(now, path, filename, spec_config.get('target', ''))
-        with ChDir(path) as _:
-            exec_pre = spec_config.get('exec_pre', '')
-            if exec_pre:
-                if not run_pre(exec_pre, filename):
-                    return []
-            if target:
-                print('rotating...', end=' ', flush=True)
-                try:
-                    os.makedirs(os.path.dirname(target), exist_ok=True)
-                    print('"{}" -> "{}"'.format(fullname, target), end=' ', flush=True)
-                    if os.path.exists(target):
-                        print('target already exists!', flush=True)
-                        return []
-                    shutil.move(fullname, target)
-                    exec_post = spec_config.get('exec_post', '')
-                    if exec_post:
-                        if not run_post(exec_post, target):
-                            return []
-                    print('done.', flush=True)
-                    compressor = spec_config.get('compress', '')
-                    if compressor:
-                        compressors.append([path] + shlex.split(compressor) + [target])
-                except OSError as exception:
-                    logging.exception(exception)
-            else:
-                print('missing target in configuration.', flush=True)
-    else:
-        print('rotation not needed.', flush=True)
+        if not need_to_rotate(spec_config, interval, filesize):
+            print('Checking "{}"... rotation not needed.'.format(fullname), flush=True, file=out)
+            add_file(fullname, 'not_needed', filesize)
+        elif not spec_config.get('target', ''):
+            print('Checking "{}"... missing target in configuration.'.format(fullname), flush=True, file=out)
+            add_file(fullname, 'missing_target', filesize)
+        else:
+            to_rotate.append((fullname, filename, spec_config, compose_target(now, path, filename, spec_config['target']), filesize))
+    if not to_rotate:
+        return []
+    path = os.path.dirname(to_rotate[0][0])
+    exec_pre = to_rotate[0][2].get('exec_pre', '')
+    if exec_pre:
+        with timed(metrics, 'exec_pre'):
+            pre_result = run_hook('exec_pre', exec_pre, [item[1] for item in to_rotate], path)
+        if not pre_result:
+            for fullname, _, _, _, filesize in to_rotate:
+                print('Checking "{}"... exec_pre failed.'.format(fullname), flush=True, file=out)
+                add_file(fullname, 'exec_pre_failed', filesize)
+            return []
+    moved = []
+    for fullname, filename, spec_config, target, filesize in to_rotate:
+        message = 'Checking "{}"... rotating...'.format(fullname)
+        start = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(os.path.join(path, target)), exist_ok=True)
+            message += ' "{}" -> "{}"'.format(fullname, target)
+            with timed(metrics, 'move'):
+                moved_target = move_log(fullname, target, spec_config)
+        except OSError as exception:
+            print(message, flush=True, file=out)
+            logging.exception(exception)
+            add_file(fullname, 'error', filesize, time.monotonic() - start)
+            continue
+        if moved_target is None:
+            print(message + ' target already exists!', flush=True, file=out)
+            add_file(fullname, 'target_exists', filesize, time.monotonic() - start)
+        else:
+            moved.append((fullname, message, spec_config, target, moved_target, filesize, time.monotonic() - start))
+    exec_post = to_rotate[0][2].get('exec_post', '')
+    # result of the batch hook belongs to every file of the batch
+    post_result = True
+    if exec_post and moved:
+        with timed(metrics, 'exec_post'):
+            post_result = run_hook('exec_post', exec_post, [item[4] for item in moved], path)
+    compressors = []
+    for fullname, message, spec_config, target, moved_target, filesize, seconds in moved:
+        if post_result:
+            print(message + ' done.', flush=True, file=out)
+            compressors += get_compressors(path, target, moved_target, spec_config)
+            add_file(fullname, 'rotated', filesize, seconds)
+        else:
+            print(message + ' exec_post failed.', flush=True, file=out)
+            add_file(fullname, 'exec_post_failed', filesize, seconds)
     return compressors
 
+def need_to_rotate(spec_config, interval, filesize):
+    """Check file by limits of its configuration"""
+    return need_to_rotate_log(
+        parse_size(spec_config.get('min_size', '0')),
+        parse_size(spec_config.get('max_size', '2T')),
+        spec_config.get('interval', None),
+        filesize,
+        interval
+    )
+
+def move_log(fullname, target, spec_config):
+    """Move or copytruncate log to target relative to its path, return target of moved (maybe compressed) file or None when target exists"""
+    # there is no chdir as paths may run in threads
+    full_target = os.path.join(os.path.dirname(fullname), target)
+    if os.path.exists(full_target):
+        return None
+    if spec_config.get('copytruncate', False):
+        stats = copy_truncate(fullname, full_target)
+        logging.info(
+            'copytruncate "%s": %d bytes in %.3f s (%.1f MB/s), %d bytes written in %.3f ms before truncation lost',
+            fullname,
+            stats.copied,
+            stats.seconds,
+            stats.copied / max(stats.seconds, 1e-6) / 1024 / 1024,
+            stats.lost,
+            stats.window * 1000
+        )
+        return target
+    compressor = spec_config.get('compress', '')
+    compress_on_move = spec_config.get('compress_on_move', False) and is_builtin(compressor)
+    moved = move_file(fullname, full_target, parse_builtin(compressor) if compress_on_move else None)
+    return target + moved[len(full_target):]
+
+def get_compressors(path, target, moved_target, spec_config):
+    """Return compressor for moved log unless it was already compressed while moving"""
+    compressor = spec_config.get('compress', '')
+    if compressor and moved_target == target:
+        return [[path] + shlex.split(compressor) + [target]]
+    return []
+
+def unique_target(path, target):
+    """Return target with a counter before its extension when it or its compressed copy already exists"""
+    base, extension = os.path.splitext(target)
+    candidate = target
+    counter = 0
+    while os.path.exists(os.path.join(path, candidate)) or glob.glob(glob.escape(os.path.join(path, candidate)) + '.*'):
+        counter += 1
+        candidate = '{}.{}{}'.format(base, counter, extension)
+    return candidate
+
 def compose_target(now, path, filename, template):
     """Fill target template by filename components and given timestamp"""
     basename, extension = os.path.splitext(filename)
@@ -145,43 +368,282 @@ def compose_target(now, path, filename, template):
             .replace('{{name}}', basename) \
             .replace('{{ext}}', extension.lstrip('.'))
 
-def run_pre(exec_pre, filename):
+def run_pre(exec_pre, filename, cwd=None, out=None):
     """Run exec_pre before log moved"""
-    exec_pre_cmd = shlex.split(exec_pre) + [filename]
-    logging.debug('exec_pre "%s"', ' '.join(exec_pre_cmd))
-    exec_pre_result = subprocess.run(exec_pre_cmd, check=False)
-    if exec_pre_result.returncode != 0:
-        print('exec_pre failed.', flush=True)
-        logging.warning(
-            'exec_pre "%s" failed with code %d',
-            ' '.join(exec_pre_cmd),
-            exec_pre_result.returncode
-        )
+    if not run_hook('exec_pre', exec_pre, [filename], cwd):
+        print('exec_pre failed.', flush=True, file=out)
         return False
     return True
 
-def run_post(exec_post, target):
+def run_post(exec_post, target, cwd=None, out=None):
     """Run exec_post after log moved"""
-    exec_post_cmd = shlex.split(exec_post) + [target]
-    logging.debug('exec_post "%s"', ' '.join(exec_post_cmd))
-    exec_post_result = subprocess.run(exec_post_cmd, check=False)
-    if exec_post_result.returncode != 0:
-        print('exec_post failed.', flush=True)
+    if not run_hook('exec_post', exec_post, [target], cwd):
+        print('exec_post failed.', flush=True, file=out)
+        return False
+    return True
+
+def run_hook(name, command, filenames, cwd=None):
+    """Run hook command with filenames as arguments, return True on success"""
+    hook_cmd = shlex.split(command) + filenames
+    logging.debug('%s "%s"', name, ' '.join(hook_cmd))
+    hook_result = subprocess.run(hook_cmd, cwd=cwd, check=False)
+    if hook_result.returncode != 0:
         logging.warning(
-            'exec_post "%s" failed with code %d',
-            ' '.join(exec_post_cmd),
-            exec_post_result.returncode
+            '%s "%s" failed with code %d',
+            name,
+            ' '.join(hook_cmd),
+            hook_result.returncode
         )
         return False
     return True
 
-def run_compressors(compressors):
-    """Exec compression precesses after rotation all files"""
+COMPRESSOR_POLL_INTERVAL = 0.05
+
+def run_compressors(compressors, jobs=1, device_jobs=0, metrics=None):
+    """Exec compression precesses after rotation all files, at most jobs at once and device_jobs per device"""
     os.nice(10)
     print('Executing compressors...', end=' ', flush=True)
-    for compressor in compressors:
-        try:
-            subprocess.run(compressor[1:], cwd=compressor[0], check=False)
-        except OSError as exception:
-            logging.exception(exception)
+    start = time.monotonic()
+    pending = [(compressor,) + compressor_file_info(compressor) for compressor in compressors]
+    running = []
+    results = []
+    while pending or running:
+        for item in list(pending):
+            if len(running) >= max(1, jobs):
+                break
+            compressor, device, size = item
+            if device_jobs and sum(1 for running_item in running if running_item[2] == device) >= device_jobs:
+                continue
+            pending.remove(item)
+            try:
+                running.append((start_compressor(compressor), compressor, device, size, time.monotonic()))
+            except OSError as exception:
+                logging.exception(exception)
+                results.append((compressor, None, 0.0, size))
+        finished = [running_item for running_item in running if running_item[0].poll() is not None]
+        if not finished and running:
+            time.sleep(COMPRESSOR_POLL_INTERVAL)
+        for running_item in finished:
+            proc, compressor, _, size, proc_start = running_item
+            running.remove(running_item)
+            results.append((compressor, proc.returncode, time.monotonic() - proc_start, size))
+            log_compressor_result(*results[-1][:3])
+    if metrics:
+        metrics.add_stage('compress', time.monotonic() - start)
+        for compressor, returncode, seconds, size in results:
+            metrics.add_compressor(os.path.join(compressor[0], compressor[-1]), returncode, size, seconds)
+    logging.info(
+        '%d compressors finished in %.2f s, %d failed',
+        len(results),
+        time.monotonic() - start,
+        sum(1 for result in results if result[1] != 0)
+    )
     print('done.', flush=True)
+    return results
+
+def start_compressor(compressor):
+    """Start external compressor or builtin one, both have poll() and returncode"""
+    if len(compressor) == 3 and is_builtin(compressor[1]):
+        proc = BuiltinCompressor(compressor[1], compressor[2], compressor[0])
+        proc.start()
+        return proc
+    return subprocess.Popen(compressor[1:], cwd=compressor[0])
+
+def compressor_file_info(compressor):
+    """Return st_dev and size of the file compressed by given compressor"""
+    try:
+        stats = os.stat(os.path.join(compressor[0], compressor[-1]))
+        return stats.st_dev, stats.st_size
+    except OSError:
+        pass
+    try:
+        return os.stat(compressor[0]).st_dev, 0
+    except OSError:
+        return None, 0
+
+def log_compressor_result(compressor, returncode, seconds):
+    """Log exit code and duration of one compressor"""
+    if returncode:
+        logging.warning('compressor "%s" failed with code %d after %.2f s', ' '.join(compressor[1:]), returncode, seconds)
+    else:
+        logging.info('compressor "%s" finished in %.2f s', ' '.join(compressor[1:]), seconds)
+
+# never matches interval of a rule, so only max_size applies
+WATCH_INTERVAL = 'watch'
+WATCH_RETRY_DELAY = 60
+WATCH_MAX_RETRY_DELAY = 3600
+WATCH_MASK = inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM \
+    | inotify.IN_DELETE | inotify.IN_ONLYDIR
+
+class Watcher:
+    """Logs of given paths followed by inotify, each one is rotated as soon as it reaches its max_size"""
+    def __init__(self, rules, paths, debounce=1.0, jobs=1, device_jobs=0):
+        self.rules = rules
+        self.paths = paths
+        self.debounce = debounce
+        self.jobs = jobs
+        self.device_jobs = device_jobs
+        self.inotify = inotify.Inotify()
+        self.watches = {}
+        self.fds = {}
+        self.pending = {}
+        self.next_check = {}
+        self.retry_delays = {}
+        self.stats = {}
+        self.queued_compressors = []
+        self.compressor_thread = None
+
+    def run(self):
+        """Scan paths and then follow changes until interrupted"""
+        self.scan()
+        while True:
+            self.step()
+
+    def step(self):
+        """Wait for inotify events or the nearest planned check and handle them"""
+        timeout = max(0.0, min(self.pending.values()) - time.monotonic()) if self.pending else None
+        if self.queued_compressors:
+            timeout = COMPRESSOR_POLL_INTERVAL if timeout is None else min(timeout, COMPRESSOR_POLL_INTERVAL)
+        events = self.inotify.read_events(timeout)
+        if events:
+            self.process_events(events)
+        self.check_pending()
+        self.start_compressors()
+
+    def scan(self):
+        """Watch paths and plan check of all their files"""
+        for path in self.paths:
+            self.watches[self.inotify.add_watch(path, WATCH_MASK)] = path
+            for fullname, _, _ in list_logs(path):
+                self.schedule(fullname)
+
+    def process_events(self, events):
+        """Plan checks of changed files, any number of events of one file results in one check"""
+        for wd, mask, _cookie, name in events:
+            if mask & inotify.IN_Q_OVERFLOW:
+                for path in self.paths:
+                    for fullname, _, _ in list_logs(path):
+                        self.schedule(fullname)
+                continue
+            if mask & inotify.IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            dirname = self.watches.get(wd)
+            if dirname is None or not name or mask & inotify.IN_ISDIR:
+                continue
+            fullname = os.path.join(dirname, name)
+            if mask & (inotify.IN_CREATE | inotify.IN_MOVED_TO | inotify.IN_MOVED_FROM | inotify.IN_DELETE):
+                self.forget(fullname)
+            if mask & (inotify.IN_MODIFY | inotify.IN_CREATE | inotify.IN_MOVED_TO):
+                self.schedule(fullname)
+
+    def schedule(self, fullname):
+        """Plan check of file with max_size, checks of one file are at least debounce seconds apart"""
+        spec_config = self.rules.get_config(os.path.basename(fullname))
+        if spec_config.get('ignore', False) or not spec_config.get('max_size'):
+            return
+        if fullname not in self.pending:
+            self.pending[fullname] = self.next_check.get(fullname, 0.0)
+
+    def check_pending(self):
+        """Check files whose planned time has come"""
+        now = time.monotonic()
+        for fullname in [fullname for fullname, due in self.pending.items() if due <= now]:
+            del self.pending[fullname]
+            self.next_check[fullname] = now + self.debounce
+            self.check(fullname)
+
+    def check(self, fullname):
+        """Rotate file when it reached its max_size, size is taken by fstat of the file kept open"""
+        spec_config = self.rules.get_config(os.path.basename(fullname))
+        start = time.perf_counter()
+        try:
+            fd = self.fds.get(fullname)
+            if fd is None:
+                fd = self.fds[fullname] = os.open(fullname, os.O_RDONLY | os.O_NONBLOCK | os.O_CLOEXEC)
+            filestat = os.fstat(fd)
+        except OSError:
+            self.forget(fullname)
+            return
+        if not stat.S_ISREG(filestat.st_mode):
+            self.forget(fullname)
+            return
+        needed = need_to_rotate(spec_config, WATCH_INTERVAL, filestat.st_size)
+        seconds = time.perf_counter() - start
+        file_stats = self.stats.setdefault(fullname, {'checks': 0, 'seconds': 0.0, 'max_seconds': 0.0, 'rotations': 0})
+        file_stats['checks'] += 1
+        file_stats['seconds'] += seconds
+        file_stats['max_seconds'] = max(file_stats['max_seconds'], seconds)
+        logging.info('Checked "%s" of %d bytes in %.1f us', fullname, filestat.st_size, seconds * 1000000)
+        if needed:
+            file_stats['rotations'] += 1
+            self.rotate(fullname, spec_config, filestat.st_size)
+
+    def rotate(self, fullname, spec_config, filesize):
+        """Rotate file by its rule to a unique target, its compressor is started in background"""
+        self.forget(fullname)
+        now = local_tz_now()
+        path, filename = os.path.split(fullname)
+        if spec_config.get('target'):
+            # the log may reach max_size more times within one period of the target mask
+            target = unique_target(path, compose_target(now, path, filename, spec_config['target']))
+            spec_config = dict(spec_config, target=target.replace('%', '%%'))
+        if spec_config.get('exec_batch', False) and (spec_config.get('exec_pre') or spec_config.get('exec_post')):
+            compressors = process_log_batch(now, WATCH_INTERVAL, [(fullname, spec_config, filesize)])
+        else:
+            compressors = process_log(now, spec_config, WATCH_INTERVAL, fullname, filesize)
+        self.check_rotated(fullname, spec_config)
+        self.queued_compressors += compressors
+        self.start_compressors()
+
+    def start_compressors(self):
+        """Run queued compressors in background thread once the previous ones finished, so jobs and device_jobs hold for all of them"""
+        if not self.queued_compressors or (self.compressor_thread is not None and self.compressor_thread.is_alive()):
+            return
+        # niceness set by run_compressors belongs to its thread only
+        self.compressor_thread = threading.Thread(target=run_compressors, args=(self.queued_compressors, self.jobs, self.device_jobs))
+        self.queued_compressors = []
+        self.compressor_thread.start()
+
+    def check_rotated(self, fullname, spec_config):
+        """Postpone next check of file which still needs rotation, the delay doubles with each failure"""
+        try:
+            failed = need_to_rotate(spec_config, WATCH_INTERVAL, os.stat(fullname).st_size)
+        except OSError:
+            failed = False
+        if not failed:
+            self.retry_delays.pop(fullname, None)
+            return
+        delay = min(self.retry_delays[fullname] * 2, WATCH_MAX_RETRY_DELAY) if fullname in self.retry_delays else WATCH_RETRY_DELAY
+        self.retry_delays[fullname] = delay
+        self.next_check[fullname] = time.monotonic() + delay
+        logging.warning('Rotation of "%s" failed, next try in %d s', fullname, delay)
+
+    def forget(self, fullname):
+        """Close kept descriptor of file which was moved, removed or replaced"""
+        fd = self.fds.pop(fullname, None)
+        if fd is not None:
+            os.close(fd)
+
+    def format_stats(self):
+        """Return cost of checks and number of rotations of each file, the most expensive first"""
+        return '\n'.join(
+            '{}: {} checks, avg {:.1f} us, max {:.1f} us, {} rotations'.format(
+                fullname,
+                item['checks'],
+                item['seconds'] / item['checks'] * 1000000,
+                item['max_seconds'] * 1000000,
+                item['rotations']
+            )
+            for fullname, item in sorted(self.stats.items(), key=lambda pair: -pair[1]['seconds'])
+        )
+
+    def close(self):
+        """Wait for running and queued compressors and stop watching"""
+        while self.compressor_thread is not None:
+            self.compressor_thread.join()
+            self.compressor_thread = None
+            self.start_compressors()
+        for fullname in list(self.fds):
+            self.forget(fullname)
+        self.inotify.close()
@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+"""Unit-tested functions for logsched"""
+
+import os
+import re
+import time
+import select
+import logging
+import datetime
+import threading
+from tplogtools.timetools import local_tz_now
+from tplogtools.logrotlib import process_paths, run_compressors, RuleSet
+from tplogtools.logcleanlib import collect_files, remove_device_files, is_listing_stable
+
+INTERVALS = ('hourly', 'daily')
+# timer fired by the monotonic clock a bit before the wall clock time must not plan the same run again
+REARM_MARGIN = 60
+R_GROUP = re.compile('(?P<group>[^0-9]+)[0-9][^/]*')
+CLEAN_DEFAULTS = {
+    'recursive': False,
+    'jobs': 1,
+    'delete_jobs': 4,
+    'min_free_space_on_device': 0,
+    'min_files_per_group': 0,
+    'min_file_age': 0,
+    'max_file_age': 99999,
+}
+
+class DirSnapshot:
+    """Directory listings shared by rotation and cleanup of one run, valid while directory mtime is unchanged"""
+
+    def __init__(self):
+        self.dirs = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def scan(self, dirname):
+        """Return name, directory flag, regular file flag and stats of every directory entry"""
+        key = os.path.abspath(dirname)
+        dir_stat = os.stat(dirname)
+        version = (dir_stat.st_dev, dir_stat.st_ino, dir_stat.st_mtime_ns)
+        with self.lock:
+            cached = self.dirs.get(key)
+            if cached and cached[0] == version:
+                self.hits += 1
+                return cached[1]
+            self.misses += 1
+        with os.scandir(dirname) as entries:
+            listing = [(entry.name, entry.is_dir(follow_symlinks=False), entry.is_file(follow_symlinks=False), entry_stat(entry)) for entry in entries]
+        with self.lock:
+            if is_listing_stable(dir_stat):
+                self.dirs[key] = (version, listing)
+            else:
+                self.dirs.pop(key, None)
+        return listing
+
+    def list_dir(self, dirname):
+        """Same as logcleanlib.list_dir, dangling symlinks are skipped"""
+        return [(name, is_dir, stats) for name, is_dir, _, stats in self.scan(dirname) if stats is not None]
+
+    def list_files(self, dirname):
+        """Same as logrotlib.list_logs"""
+        return [(os.path.join(dirname, name), name, stats) for name, _, is_file, stats in self.scan(dirname) if is_file]
+
+def entry_stat(entry):
+    """Return stats of directory entry followed through symlink, None for a dangling symlink"""
+    try:
+        return entry.stat()
+    except FileNotFoundError:
+        return None
+
+def parse_config(conf):
+    """Check scheduler configuration and return it with defaults filled in"""
+    if not isinstance(conf, dict) or not (conf.get('logrot') or conf.get('logclean')):
+        raise ValueError('Configuration must contain logrot or logclean')
+    rot_conf = conf.get('logrot') or {}
+    clean_conf = dict(CLEAN_DEFAULTS, **(conf.get('logclean') or {}))
+    schedule_conf = conf.get('schedule') or {}
+    if rot_conf and not rot_conf.get('paths'):
+        raise ValueError('Missing paths of logrot')
+    if conf.get('logclean') and not clean_conf.get('paths'):
+        raise ValueError('Missing paths of logclean')
+    try:
+        daily_hour, daily_minute = (int(item) for item in str(schedule_conf.get('daily', '00:00')).split(':'))
+        hourly_minute = int(schedule_conf.get('hourly', 0))
+    except ValueError:
+        raise ValueError('Bad schedule "{}"'.format(schedule_conf))
+    if not 0 <= hourly_minute < 60 or not 0 <= daily_hour < 24 or not 0 <= daily_minute < 60:
+        raise ValueError('Bad schedule "{}"'.format(schedule_conf))
+    return {
+        'rules': RuleSet(rot_conf.get('rules') or {}),
+        'rot_paths': [os.path.abspath(path) for path in rot_conf.get('paths') or []],
+        'path_jobs': int(rot_conf.get('path_jobs', 1)),
+        'jobs': int(rot_conf.get('jobs', 1)),
+        'device_jobs': int(rot_conf.get('device_jobs', 0)),
+        'clean_paths': list(clean_conf.get('paths') or []),
+        'recursive': bool(clean_conf['recursive']),
+        'clean_jobs': int(clean_conf['jobs']),
+        'delete_jobs': int(clean_conf['delete_jobs']),
+        'min_free_space_on_device': int(clean_conf['min_free_space_on_device']),
+        'min_files_per_group': int(clean_conf['min_files_per_group']),
+        'min_file_age': int(clean_conf['min_file_age']),
+        'max_file_age': int(clean_conf['max_file_age']),
+        'hourly': (None, hourly_minute),
+        'daily': (daily_hour, daily_minute),
+    }
+
+def seconds_to_interval(now, interval, config):
+    """Return seconds from naive local now to the next run of hourly or daily interval, DST changes are counted in"""
+    hour, minute = config[interval]
+    target = now.replace(hour=now.hour if hour is None else hour, minute=minute, second=0, microsecond=0)
+    if target <= now:
+        target += datetime.timedelta(hours=1) if hour is None else datetime.timedelta(days=1)
+    return target.timestamp() - now.timestamp()
+
+class Scheduler:
+    """Resident logrot and logclean running hourly and daily intervals on monotonic timers, the configuration is reloaded on request"""
+    def __init__(self, loader, clock=time.monotonic):
+        self.loader = loader
+        self.clock = clock
+        self.config = parse_config(loader())
+        self.deadlines = {}
+        self.reload_requested = False
+        self.compressor_thread = None
+        self.wakeup_read, self.wakeup_write = os.pipe()
+        os.set_blocking(self.wakeup_write, False)
+        self.arm()
+
+    def arm(self, intervals=INTERVALS, margin=0):
+        """Set timers of intervals by the wall clock, they wait on the monotonic clock"""
+        now = datetime.datetime.now() + datetime.timedelta(seconds=margin)
+        start = self.clock()
+        for interval in intervals:
+            self.deadlines[interval] = start + margin + seconds_to_interval(now, interval, self.config)
+
+    def request_reload(self):
+        """Ask the main loop to reload configuration, safe to call from a signal handler"""
+        self.reload_requested = True
+        try:
+            os.write(self.wakeup_write, b'\0')
+        except BlockingIOError:
+            pass
+
+    def reload(self):
+        """Load configuration again, the current one is kept when the new one is broken"""
+        self.reload_requested = False
+        try:
+            self.config = parse_config(self.loader())
+        except (OSError, ValueError) as exception:
+            logging.error('Reload of configuration failed, the previous one is kept: %s', exception)
+            return False
+        self.arm()
+        print('Configuration reloaded.', flush=True)
+        return True
+
+    def due(self):
+        """Return intervals whose timers expired"""
+        now = self.clock()
+        return [interval for interval in INTERVALS if self.deadlines[interval] <= now]
+
+    def wait(self):
+        """Sleep until the nearest timer or reload request"""
+        timeout = max(0.0, min(self.deadlines.values()) - self.clock())
+        if select.select([self.wakeup_read], [], [], timeout)[0]:
+            os.read(self.wakeup_read, 4096)
+
+    def run_intervals(self, intervals):
+        """Rotate logs of given intervals and clean old files over one directory snapshot"""
+        config = self.config
+        snapshot = DirSnapshot()
+        start = time.monotonic()
+        print('Running {} at {}'.format(', '.join(intervals), local_tz_now().isoformat()), flush=True)
+        compressors = []
+        for interval in intervals:
+            compressors += process_paths(local_tz_now(), config['rules'], interval, config['rot_paths'], config['path_jobs'], None, snapshot)
+        if config['clean_paths']:
+            self.clean(config, snapshot)
+        print('Run finished in {:.2f} s, {} directories listed, {} listings reused'.format(
+            time.monotonic() - start,
+            snapshot.misses,
+            snapshot.hits
+        ), flush=True)
+        if compressors:
+            self.start_compressors(compressors, config)
+        return snapshot
+
+    @staticmethod
+    def clean(config, snapshot):
+        """Remove old files by logclean limits, listings are taken from snapshot"""
+        paths = [path for path in config['clean_paths'] if os.access(path, os.R_OK)]
+        devices = collect_files(paths, R_GROUP, config['min_free_space_on_device'], time.time(), config['recursive'], snapshot, config['clean_jobs'])
+        removed = False
+        for device in devices.values():
+            to_remove = device.get_files_to_remove(config['min_files_per_group'], config['min_file_age'], config['max_file_age'])
+            if to_remove:
+                remove_device_files(device, to_remove, config['delete_jobs'])
+                removed = True
+        if not removed:
+            print("No file matches delete criteria.", flush=True)
+
+    def start_compressors(self, compressors, config):
+        """Run compressors in background thread after those of previous runs, so jobs and device_jobs hold across runs"""
+        previous = self.compressor_thread
+        def compress():
+            nonlocal previous
+            if previous is not None:
+                previous.join()
+                previous = None
+            # niceness set by run_compressors belongs to this thread only
+            run_compressors(compressors, config['jobs'], config['device_jobs'])
+        self.compressor_thread = threading.Thread(target=compress)
+        self.compressor_thread.start()
+
+    def step(self):
+        """Wait for the nearest event and handle it"""
+        self.wait()
+        if self.reload_requested:
+            self.reload()
+        intervals = self.due()
+        if intervals:
+            try:
+                self.run_intervals(intervals)
+            except Exception: # pylint: disable=broad-except
+                # one failed run must not stop the schedule
+                logging.exception('Run of %s failed', ', '.join(intervals))
+            finally:
+                # timers follow the wall clock again, so DST changes, suspend and clock drift do not shift runs,
+                # runs missed meanwhile are not repeated
+                self.arm(intervals, REARM_MARGIN)
+
+    def run(self):
+        """Main loop running till interrupted"""
+        while True:
+            self.step()
+
+    def close(self):
+        """Wait for running compressors and release the wakeup pipe"""
+        if self.compressor_thread is not None:
+            self.compressor_thread.join()
+        os.close(self.wakeup_read)
+        os.close(self.wakeup_write)
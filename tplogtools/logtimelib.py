@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+"""Library for logtime"""
+
+import os
+import io
+import sys
+import stat
+import time
+import signal
+import selectors
+
+IOV_MAX = os.sysconf('SC_IOV_MAX') if 'SC_IOV_MAX' in os.sysconf_names else 1024
+
+class OutputBuffer:
+    """Collects written data and flushes it in batches after max_bytes or max_delay seconds, without limits every write is flushed"""
+    def __init__(self, output, max_bytes=0, max_delay=0):
+        self.output = output
+        try:
+            self.fileno = output.fileno()
+        except (AttributeError, io.UnsupportedOperation):
+            self.fileno = None
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.chunks = []
+        self.size = 0
+        self.in_write = False
+        self.flush_needed = False
+        if max_delay:
+            signal.signal(signal.SIGALRM, lambda signum, frame: self.alarm_handler())
+
+    def write(self, data):
+        """Add data to the batch, flush it when some limit is reached"""
+        self.in_write = True
+        self.chunks.append(data)
+        self.size += len(data)
+        if not self.max_bytes and not self.max_delay or self.max_bytes and self.size >= self.max_bytes:
+            self.write_out()
+        elif self.max_delay and len(self.chunks) == 1:
+            signal.setitimer(signal.ITIMER_REAL, self.max_delay)
+        self.in_write = False
+        if self.flush_needed:
+            self.flush()
+
+    def writelines(self, pieces):
+        """Write pieces of lines, without limits they are passed to writev as they are, otherwise they are copied to the batch"""
+        if self.max_bytes or self.max_delay:
+            self.write(b''.join(pieces))
+            return
+        self.in_write = True
+        self.chunks = pieces
+        self.write_out()
+        self.in_write = False
+
+    def flush(self):
+        """Write out the whole batch"""
+        self.in_write = True
+        self.write_out()
+        self.in_write = False
+
+    def write_out(self):
+        """Write the batch by one call and cancel the delay timer"""
+        self.flush_needed = False
+        if self.chunks:
+            if self.fileno is None:
+                self.output.write(b''.join(self.chunks))
+                self.output.flush()
+            else:
+                self.output.flush()
+                write_vectors(self.fileno, self.chunks)
+            self.chunks = []
+            self.size = 0
+        if self.max_delay:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+
+    def alarm_handler(self):
+        """Flush after max_delay, postponed when the alarm comes in the middle of a write"""
+        if self.in_write:
+            self.flush_needed = True
+        else:
+            self.flush()
+
+def write_vectors(fd, chunks):
+    """Write all chunks by as few writev calls as possible"""
+    index = 0
+    while index < len(chunks):
+        written = os.writev(fd, chunks[index:index + IOV_MAX])
+        while index < len(chunks) and written >= len(chunks[index]):
+            written -= len(chunks[index])
+            index += 1
+        if written:
+            chunks[index] = memoryview(chunks[index])[written:]
+
+def copy_lines(stream, output, formatter):
+    """Copy lines from stream with the time of reading of each line"""
+    while True:
+        line = stream.readline()
+        if line == b'':
+            break
+        output.write(formatter.format(time.time()).encode('utf8') + b' ' + line)
+
+class LineSplitter:
+    """Splits chunks read into one reused buffer into lines, lines of one chunk get the time of its reading,
+    with whole_lines each write ends by newline, so output of more splitters can be merged"""
+    def __init__(self, read_size, tag=b'', whole_lines=False):
+        self.buffer = bytearray(read_size)
+        self.view = memoryview(self.buffer)
+        self.filled = 0
+        self.continued = False
+        self.tag = tag
+        self.whole_lines = whole_lines
+
+    def prefix(self, formatter):
+        """Return time and tag to insert before line"""
+        return formatter.format(time.time()).encode('utf8') + b' ' + self.tag
+
+    def read(self, fd, output, formatter):
+        """Read one chunk and write its complete lines, return False at the end of input"""
+        try:
+            size = os.readv(fd, [self.view[self.filled:]])
+        except BlockingIOError:
+            return True
+        if size == 0:
+            self.finish(output, formatter)
+            return False
+        buffer, view = self.buffer, self.view
+        end = self.filled + size
+        prefix = self.prefix(formatter)
+        pieces = []
+        start = 0
+        newline = buffer.find(b'\n', self.filled, end)
+        while newline >= 0:
+            if not self.continued:
+                pieces.append(prefix)
+            self.continued = False
+            pieces.append(view[start:newline + 1])
+            start = newline + 1
+            newline = buffer.find(b'\n', start, end)
+        if start == 0 and end == len(buffer):
+            # line longer than the buffer is written in parts, the time is only before the first one
+            if not self.continued:
+                pieces.append(prefix)
+            pieces.append(view[:end])
+            if self.whole_lines:
+                pieces.append(b'\n')
+            else:
+                self.continued = True
+            start = end
+        if pieces:
+            output.writelines(pieces)
+        self.filled = end - start
+        if self.filled:
+            buffer[:self.filled] = bytes(view[start:end])
+        return True
+
+    def finish(self, output, formatter):
+        """Write the rest of input without trailing newline"""
+        if self.filled:
+            output.writelines(([] if self.continued else [self.prefix(formatter)]) + [self.view[:self.filled]] + ([b'\n'] if self.whole_lines else []))
+            self.filled = 0
+
+def copy_chunks(fd, output, formatter, read_size):
+    """Copy lines read by chunks into one reusable buffer"""
+    splitter = LineSplitter(read_size)
+    while splitter.read(fd, output, formatter):
+        pass
+
+def open_source(spec):
+    """Open source given as [tag=]path, [tag=]fd:number or [tag=]- for stdin, return its fd and tag"""
+    tag, separator, target = spec.partition('=')
+    if not separator:
+        tag, target = '', spec
+    if target == '-':
+        fd = sys.stdin.buffer.fileno()
+    elif target.startswith('fd:'):
+        fd = int(target[3:])
+    else:
+        # FIFO opened without writer does not block and is not readable until some writer comes
+        fd = os.open(target, os.O_RDONLY | os.O_NONBLOCK)
+    return fd, tag or target
+
+def copy_sources(sources, output, formatter, read_size, tags=False):
+    """Merge lines of more sources given as (fd, tag) by one selector loop, lines longer than read_size are split"""
+    files = []
+    with selectors.DefaultSelector() as selector:
+        for fd, tag in sources:
+            splitter = LineSplitter(read_size, tag.encode('utf8') + b' ' if tags else b'', True)
+            if stat.S_ISREG(os.fstat(fd).st_mode):
+                # epoll refuses regular files, they are always readable, so one chunk is read from each per round
+                files.append((fd, splitter))
+            else:
+                selector.register(fd, selectors.EVENT_READ, splitter)
+        while files or selector.get_map():
+            if selector.get_map():
+                for key, _ in selector.select(0 if files else None):
+                    if not key.data.read(key.fd, output, formatter):
+                        selector.unregister(key.fd)
+            files = [(fd, splitter) for fd, splitter in files if splitter.read(fd, output, formatter)]
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Timings, byte counts and outcomes collected during one run"""
+
+import os
+import json
+import time
+import threading
+import contextlib
+import collections
+
+class RunMetrics:
+    """Per-file and per-stage metrics of one run, safe to use from threads"""
+    def __init__(self, tool):
+        self.tool = tool
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.start = time.monotonic()
+        self.stages = collections.OrderedDict()
+        self.files = []
+        self.compressors = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager adding its duration to the given stage"""
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.monotonic() - start)
+
+    def add_stage(self, name, seconds):
+        """Add duration to the stage, durations from parallel workers are summed"""
+        with self.lock:
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+
+    def add_file(self, filename, outcome, size, seconds):
+        """Record result of processing of one file"""
+        with self.lock:
+            self.files.append({'file': filename, 'outcome': outcome, 'bytes': size, 'seconds': seconds})
+
+    def add_compressor(self, filename, returncode, size, seconds):
+        """Record result of compression of one file"""
+        with self.lock:
+            self.compressors.append({'file': filename, 'returncode': returncode, 'bytes': size, 'seconds': seconds})
+
+    def summary(self):
+        """Return all metrics as dict ready for JSON"""
+        outcomes = collections.Counter(record['outcome'] for record in self.files)
+        compressed = [record for record in self.compressors if record['returncode'] == 0]
+        return {
+            'tool': self.tool,
+            'started': self.started,
+            'seconds': time.monotonic() - self.start,
+            'stages': dict(self.stages),
+            'outcomes': dict(outcomes),
+            'rotated_bytes': sum(record['bytes'] for record in self.files if record['outcome'] == 'rotated'),
+            'compressed_bytes': sum(record['bytes'] for record in compressed),
+            'compress_seconds': sum(record['seconds'] for record in compressed),
+            'compress_failed': len(self.compressors) - len(compressed),
+            'files': self.files,
+            'compressors': self.compressors,
+        }
+
+    def to_json(self):
+        """Return JSON summary"""
+        return json.dumps(self.summary(), indent=2, sort_keys=True) + '\n'
+
+    def to_prometheus(self):
+        """Return summary in Prometheus text exposition format"""
+        summary = self.summary()
+        prefix = self.tool
+        lines = [
+            '# HELP {}_last_run_timestamp_seconds Start of the last run.'.format(prefix),
+            '# TYPE {}_last_run_timestamp_seconds gauge'.format(prefix),
+            '{}_last_run_timestamp_seconds {:.3f}'.format(prefix, summary['started']),
+            '# HELP {}_run_seconds Duration of the last run.'.format(prefix),
+            '# TYPE {}_run_seconds gauge'.format(prefix),
+            '{}_run_seconds {:.6f}'.format(prefix, summary['seconds']),
+            '# HELP {}_stage_seconds Time spent in stage, summed over workers.'.format(prefix),
+            '# TYPE {}_stage_seconds gauge'.format(prefix),
+        ]
+        lines += ['{}_stage_seconds{{stage="{}"}} {:.6f}'.format(prefix, stage, seconds) for stage, seconds in sorted(summary['stages'].items())]
+        lines += [
+            '# HELP {}_files Number of checked files by outcome.'.format(prefix),
+            '# TYPE {}_files gauge'.format(prefix),
+        ]
+        lines += ['{}_files{{outcome="{}"}} {}'.format(prefix, outcome, count) for outcome, count in sorted(summary['outcomes'].items())]
+        for name, help_text in (
+                ('rotated_bytes', 'Size of rotated files.'),
+                ('compressed_bytes', 'Size of successfully compressed files before compression.'),
+                ('compress_seconds', 'Time spent by successful compressors.'),
+                ('compress_failed', 'Number of failed compressors.')
+            ):
+            lines += [
+                '# HELP {}_{} {}'.format(prefix, name, help_text),
+                '# TYPE {}_{} gauge'.format(prefix, name),
+                '{}_{} {}'.format(prefix, name, summary[name]),
+            ]
+        return '\n'.join(lines) + '\n'
+
+def timed(metrics, stage):
+    """Time stage when metrics are collected"""
+    return metrics.stage(stage) if metrics else contextlib.suppress()
+
+def write_atomically(filename, content):
+    """Replace file content at once, textfile collector never reads half written file"""
+    if filename == '-':
+        print(content, end='', flush=True)
+        return
+    temp_name = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(temp_name, 'w') as output:
+        output.write(content)
+    os.replace(temp_name, filename)
@@ -0,0 +1,572 @@
+#!/usr/bin/env python3
+"""Library for stdout2log"""
+
+import os
+import time
+import queue
+import socket
+import selectors
+import datetime
+import logging
+import subprocess
+import shlex
+import tempfile
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from tplogtools.timetools import how_many_seconds_to_time
+from tplogtools.compresstools import parse_builtin, FORMATS
+
+READ_SIZE = 65536
+SPILL_READ_SIZE = 1024 * 1024
+OVERFLOW_POLICIES = ('block', 'drop', 'spill')
+STREAM_BLOCK_SIZE = 1024 * 1024
+COMPRESSOR_POLL_INTERVAL = 0.5
+
+class State:
+    """Live log with its rotation settings, writes are collected up to max_buffer bytes or max_delay seconds,
+    with stream_compressor each written block is an independent compressed member,
+    with preallocate the live log is allocated up to max_size at once and trimmed at close,
+    with drop_cache the rotated log is removed from page cache"""
+    def __init__(self, wanted_hour, wanted_minute, max_size, backup_mask, filename, compressor, max_buffer=0, max_delay=0, stream_compressor=None, preallocate=False, drop_cache=False):
+        self.wanted_hour = wanted_hour
+        self.wanted_minute = wanted_minute
+        self.max_size = max_size
+        self.backup_mask = backup_mask
+        self.filename = filename
+        self.compressor = compressor
+        self.running_compressors = []
+        self.max_buffer = max_buffer
+        self.max_delay = max_delay
+        self.chunks = []
+        self.buffered = 0
+        self.pending_since = None
+        self.output = None
+        self.size = 0
+        self.compress = None
+        self.executor = None
+        self.in_flight = collections.deque()
+        self.preallocate = preallocate and max_size is not None
+        self.drop_cache = drop_cache
+        if stream_compressor:
+            fmt, self.level, self.threads = parse_builtin(stream_compressor)
+            self.compress = FORMATS[fmt][2]
+            self.max_buffer = max_buffer or STREAM_BLOCK_SIZE
+        self.open()
+
+    def open(self):
+        """Open live log for appending, its size is counted in memory since now"""
+        if self.compress is not None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        if not self.preallocate:
+            self.output = open(self.filename, 'ab', 0)
+            self.size = os.fstat(self.output.fileno()).st_size
+            return
+        # preallocated file is longer than its data, so it is written from the end of data instead of appended
+        fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        self.output = open(fd, 'wb', 0)
+        self.size = os.fstat(fd).st_size
+        # file trimmed at clean close is shorter than max_size and its trailing zeros are data
+        if self.size >= self.max_size:
+            self.size = find_data_end(fd, self.size)
+        self.output.seek(self.size)
+        try:
+            os.posix_fallocate(fd, 0, max(self.max_size, self.size))
+        except OSError as exception:
+            logging.warning('Preallocation of "%s" failed: %s', self.filename, exception)
+            self.preallocate = False
+
+    def write(self, data):
+        """Add data to the buffer, write it out when max_buffer is reached"""
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        if self.compress is None:
+            self.size += len(data)
+        if self.buffered >= self.max_buffer:
+            self.flush(wait=False)
+
+    def flush(self, wait=True):
+        """Write out the buffer, compressed blocks are written in order as they are finished, all of them with wait"""
+        if self.chunks:
+            data = b''.join(self.chunks)
+            if self.compress is None:
+                self.write_out(data)
+            else:
+                self.in_flight.append((self.pending_since, self.executor.submit(self.compress, data, self.level)))
+        self.chunks = []
+        self.buffered = 0
+        self.pending_since = None
+        # only a bounded number of blocks is kept in memory
+        while self.in_flight and (wait or len(self.in_flight) > self.threads or self.in_flight[0][1].done()):
+            compressed = self.in_flight.popleft()[1].result()
+            self.size += len(compressed)
+            self.write_out(compressed)
+
+    def write_out(self, data):
+        """Write all data to live log"""
+        data = memoryview(data)
+        while data:
+            data = data[self.output.write(data):]
+
+    def flush_timeout(self):
+        """Return seconds to the flush of buffered data, None if nothing is waiting"""
+        # compressed blocks still in flight are older than the buffer and have to reach the live log in time too
+        since = self.in_flight[0][0] if self.in_flight else self.pending_since
+        if since is None:
+            return None
+        return max(0, since + self.max_delay - time.monotonic())
+
+    def size_exceeded(self):
+        """Return True when live log reached max_size"""
+        return self.max_size is not None and self.size >= self.max_size
+
+    def close(self, drop_cache=False):
+        """Flush and close live log, the rest of preallocated space is trimmed"""
+        self.flush()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+        if self.preallocate:
+            self.output.truncate(self.output.tell())
+        if drop_cache:
+            # only clean pages can be dropped
+            os.fdatasync(self.output.fileno())
+            os.posix_fadvise(self.output.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        self.output.close()
+
+def find_data_end(fd, size):
+    """Return length of file without trailing zeros left by preallocation"""
+    end = size
+    while end > 0:
+        start = max(0, end - READ_SIZE)
+        data = os.pread(fd, end - start, start).rstrip(b'\0')
+        if data:
+            return start + len(data)
+        end = start
+    return 0
+
+def rotate(state, now, pool=None):
+    """Move live log to backup name and start compressor of it, or pass it to the pool"""
+    state.close(state.drop_cache)
+    backup_name = now.strftime(state.backup_mask)
+    dirname = os.path.dirname(backup_name)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    os.rename(state.filename, backup_name)
+    if state.compressor:
+        compressor_params = shlex.split(state.compressor)
+        compressor_params.append(backup_name)
+        if pool is None:
+            state.running_compressors.append(subprocess.Popen(compressor_params))
+        else:
+            pool.submit(compressor_params)
+    state.open()
+
+def write_lines(state, data, pool=None):
+    """Write whole lines to live log, it is rotated right after the line which reached max_size"""
+    if state.max_size is None or state.compress is not None:
+        # size of compressed live log is known only after its blocks are written
+        state.write(data)
+        return
+    start = 0
+    while state.size + len(data) - start >= state.max_size:
+        limit = start + max(state.max_size - state.size, 1) - 1
+        end = data.find(b'\n', limit) + 1 or len(data)
+        state.write(data[start:end])
+        rotate(state, datetime.datetime.now(), pool)
+        start = end
+        if start == len(data):
+            return
+    state.write(data[start:] if start else data)
+
+def reap_compressors(state):
+    """Forget finished compressors"""
+    compressors = state.running_compressors
+    state.running_compressors = []
+    for proc in compressors:
+        if proc.poll() is None:
+            state.running_compressors.append(proc)
+        else:
+            logging.debug('Compressor terminated')
+
+class Writer(threading.Thread):
+    """Thread writing and rotating live log, input waits in queue of queue_size chunks,
+    when it is full the chunk is waited for (block), dropped (drop) or stored to temporary file (spill)"""
+    def __init__(self, state, queue_size=64, overflow='block'):
+        super().__init__(name='writer', daemon=True)
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Bad overflow policy "{}"'.format(overflow))
+        self.state = state
+        self.queue = queue.Queue(queue_size)
+        self.overflow = overflow
+        self.lock = threading.Lock()
+        self.spill = None
+        self.spill_start = 0
+        self.spill_end = 0
+        self.error = None
+        self.stopping = False
+        self.stats = {'queued': 0, 'max_depth': 0, 'blocked_seconds': 0.0, 'dropped': 0, 'dropped_bytes': 0, 'spilled_bytes': 0}
+
+    def put(self, data):
+        """Pass chunk of whole lines to the writer, OSError is raised once the writer failed"""
+        self.check()
+        with self.lock:
+            if self.spill_end:
+                self.write_spill(data)
+                return
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            if self.overflow == 'drop':
+                self.stats['dropped'] += 1
+                self.stats['dropped_bytes'] += len(data)
+                return
+            if self.overflow == 'spill':
+                with self.lock:
+                    self.write_spill(data)
+                return
+            start = time.monotonic()
+            self.put_blocking(data)
+            self.stats['blocked_seconds'] += time.monotonic() - start
+        self.stats['queued'] += 1
+        self.stats['max_depth'] = max(self.stats['max_depth'], self.queue.qsize())
+
+    def put_blocking(self, data):
+        """Wait for free place in queue while the writer is alive"""
+        while True:
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except queue.Full:
+                self.check()
+
+    def check(self):
+        """Raise OSError when the started writer is not running anymore"""
+        if self.error is not None or (self.ident is not None and not self.is_alive()):
+            raise OSError('Writer of "{}" failed: {}'.format(self.state.filename, self.error))
+
+    def write_spill(self, data):
+        """Append chunk to spill file, called with lock held"""
+        if self.spill is None:
+            self.spill = tempfile.TemporaryFile(dir=os.path.dirname(os.path.abspath(self.state.filename)))
+        os.pwrite(self.spill.fileno(), data, self.spill_end)
+        self.spill_end += len(data)
+        self.stats['spilled_bytes'] += len(data)
+
+    def read_spill(self):
+        """Return next whole lines from spill file, empty bytes when all spilled data were read"""
+        with self.lock:
+            end = self.spill_end
+            if self.spill_start >= end:
+                os.ftruncate(self.spill.fileno(), 0)
+                self.spill_start = self.spill_end = 0
+                return b''
+        data = os.pread(self.spill.fileno(), min(SPILL_READ_SIZE, end - self.spill_start), self.spill_start)
+        lines_end = data.rfind(b'\n') + 1
+        if lines_end:
+            data = data[:lines_end]
+        self.spill_start += len(data)
+        return data
+
+    def stop(self):
+        """Write out all waiting data and wait for the end of writer"""
+        if self.is_alive():
+            self.put_blocking(None)
+            self.join()
+        if self.spill is not None:
+            self.spill.close()
+        if self.error is not None:
+            raise OSError('Writer of "{}" failed: {}'.format(self.state.filename, self.error))
+
+    def run(self):
+        """Write chunks from queue, rotate at wanted time or size and flush buffered data after max_delay"""
+        state = self.state
+        deadline = rotation_deadline(state)
+        try:
+            while True:
+                data = self.next_chunk(deadline)
+                if data is None:
+                    if not self.spill_end:
+                        break
+                    self.stopping = True
+                    continue
+                if data:
+                    write_lines(state, data)
+                if time.monotonic() >= deadline:
+                    rotate(state, datetime.datetime.now())
+                    deadline = rotation_deadline(state)
+                elif state.size_exceeded():
+                    rotate(state, datetime.datetime.now())
+                elif state.flush_timeout() == 0:
+                    state.flush()
+                reap_compressors(state)
+        except OSError as exception:
+            self.error = exception
+            logging.exception(exception)
+        finally:
+            state.close()
+
+    def next_chunk(self, deadline):
+        """Return next chunk, spilled data go after the queue, empty bytes when timeout elapsed"""
+        if self.spill_end and self.queue.empty():
+            data = self.read_spill()
+            if data or not self.stopping:
+                return data
+        if self.stopping:
+            return None
+        timeout = deadline - time.monotonic()
+        flush_timeout = self.state.flush_timeout()
+        if flush_timeout is not None:
+            timeout = min(timeout, flush_timeout)
+        if self.state.running_compressors:
+            # finished compressors are reaped also when no input comes
+            timeout = min(timeout, COMPRESSOR_POLL_INTERVAL)
+        try:
+            return self.queue.get(timeout=max(0, timeout))
+        except queue.Empty:
+            return b''
+
+    def format_stats(self):
+        """Return queue statistics as one line"""
+        return 'queued {queued} chunks, max depth {max_depth}, blocked {blocked_seconds:.2f} s, dropped {dropped} chunks ({dropped_bytes} B), spilled {spilled_bytes} B'.format(**self.stats)
+
+def rotation_deadline(state):
+    """Return monotonic time of the next rotation at wanted time"""
+    return time.monotonic() + how_many_seconds_to_time(now=datetime.datetime.now(), hour=state.wanted_hour, minute=state.wanted_minute)
+
+def copy_input(fd, writer):
+    """Pass input to the writer by chunks of whole lines"""
+    partial = []
+    while True:
+        data = os.read(fd, READ_SIZE)
+        if data == b'':
+            break
+        end = data.rfind(b'\n') + 1
+        if not end:
+            partial.append(data)
+            continue
+        if partial:
+            partial.append(data[:end])
+            writer.put(b''.join(partial))
+        else:
+            writer.put(data[:end])
+        partial = [data[end:]] if end < len(data) else []
+    if partial:
+        writer.put(b''.join(partial))
+
+class CompressorPool:
+    """Compressors of rotated logs shared by more streams, at most jobs of them run at once"""
+    def __init__(self, jobs=1):
+        self.jobs = max(1, jobs)
+        self.pending = collections.deque()
+        self.running = []
+
+    def submit(self, params):
+        """Start compressor when the limit allows it, otherwise queue it"""
+        self.pending.append(params)
+        self.start()
+
+    def start(self):
+        """Start queued compressors up to the limit"""
+        while self.pending and len(self.running) < self.jobs:
+            params = self.pending.popleft()
+            try:
+                self.running.append(subprocess.Popen(params))
+            except OSError as exception:
+                logging.exception(exception)
+
+    def poll(self):
+        """Forget finished compressors and start queued ones, return True while some compressor is queued or running"""
+        self.running = [proc for proc in self.running if proc.poll() is None]
+        self.start()
+        return bool(self.pending or self.running)
+
+    def wait(self):
+        """Wait for all queued and running compressors"""
+        while self.poll():
+            time.sleep(COMPRESSOR_POLL_INTERVAL)
+
+class Stream:
+    """Named stream of the collector with its live log and time of the next rotation"""
+    def __init__(self, name, state, fifo=None, offset=0):
+        self.name = name
+        self.state = state
+        self.fifo = fifo
+        self.offset = offset
+        self.deadline = rotation_deadline(state) + offset
+
+class Connection:
+    """Input of the collector, socket connection starts by the name of its stream on the first line"""
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.partial = []
+
+class Collector:
+    """Writes many named streams coming from FIFOs or Unix socket by one selector loop"""
+    def __init__(self, streams, socket_path=None, compress_jobs=1):
+        self.streams = {stream.name: stream for stream in streams}
+        self.socket_path = socket_path
+        self.pool = CompressorPool(compress_jobs)
+        self.selector = selectors.DefaultSelector()
+        self.server = None
+
+    def open(self):
+        """Open FIFOs of streams and listening socket"""
+        for stream in self.streams.values():
+            if stream.fifo:
+                if not os.path.exists(stream.fifo):
+                    os.mkfifo(stream.fifo)
+                # opened also for writing, so FIFO does not end when its writer goes away
+                fd = os.open(stream.fifo, os.O_RDWR | os.O_NONBLOCK)
+                self.selector.register(fd, selectors.EVENT_READ, Connection(stream))
+        if self.socket_path:
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.server.bind(self.socket_path)
+            self.server.listen()
+            self.server.setblocking(False)
+            self.selector.register(self.server, selectors.EVENT_READ, None)
+
+    def run(self):
+        """Serve inputs until interrupted"""
+        self.open()
+        try:
+            while True:
+                self.step(self.timeout())
+        finally:
+            self.close()
+
+    def timeout(self):
+        """Return seconds to the nearest rotation, flush or check of compressors"""
+        now = time.monotonic()
+        timeouts = [stream.deadline - now for stream in self.streams.values()]
+        timeouts += [timeout for timeout in (stream.state.flush_timeout() for stream in self.streams.values()) if timeout is not None]
+        if self.pool.pending or self.pool.running:
+            timeouts.append(COMPRESSOR_POLL_INTERVAL)
+        return max(0, min(timeouts)) if timeouts else None
+
+    def step(self, timeout):
+        """Serve ready inputs, then rotate and flush streams whose time has come"""
+        for key, _ in self.selector.select(timeout):
+            if key.data is None:
+                self.accept()
+            else:
+                self.read(key.fileobj, key.data)
+        now = time.monotonic()
+        for stream in self.streams.values():
+            if now >= stream.deadline:
+                rotate(stream.state, datetime.datetime.now(), self.pool)
+                stream.deadline = rotation_deadline(stream.state) + stream.offset
+            elif stream.state.flush_timeout() == 0:
+                stream.state.flush()
+        self.pool.poll()
+
+    def accept(self):
+        """Accept new connection, its stream is known after the first line"""
+        connection, _ = self.server.accept()
+        connection.setblocking(False)
+        self.selector.register(connection, selectors.EVENT_READ, Connection())
+
+    def read(self, fileobj, connection):
+        """Read chunk of input and write its whole lines to the stream"""
+        try:
+            data = fileobj.recv(READ_SIZE) if isinstance(fileobj, socket.socket) else os.read(fileobj, READ_SIZE)
+        except BlockingIOError:
+            return
+        if data == b'':
+            self.disconnect(fileobj, connection)
+            return
+        if connection.stream is None:
+            data = b''.join(connection.partial) + data
+            connection.partial = []
+            end = data.find(b'\n')
+            if end < 0:
+                connection.partial = [data]
+                return
+            name = data[:end].decode('utf8', 'replace').strip()
+            if name not in self.streams:
+                logging.warning('Unknown stream "%s"', name)
+                self.disconnect(fileobj, Connection())
+                return
+            connection.stream = self.streams[name]
+            data = data[end + 1:]
+        end = data.rfind(b'\n') + 1
+        if not end:
+            connection.partial.append(data)
+            return
+        lines = b''.join(connection.partial + [data[:end]]) if connection.partial else data[:end]
+        connection.partial = [data[end:]] if end < len(data) else []
+        state = connection.stream.state
+        write_lines(state, lines, self.pool)
+        if state.size_exceeded():
+            rotate(state, datetime.datetime.now(), self.pool)
+
+    def disconnect(self, fileobj, connection):
+        """Write the rest of input and close it"""
+        if connection.stream is not None and connection.partial:
+            write_lines(connection.stream.state, b''.join(connection.partial) + b'\n', self.pool)
+        connection.partial = []
+        self.selector.unregister(fileobj)
+        if isinstance(fileobj, socket.socket):
+            fileobj.close()
+        else:
+            os.close(fileobj)
+
+    def close(self):
+        """Close inputs and live logs, wait for compressors"""
+        for key in list(self.selector.get_map().values()):
+            if key.data is not None:
+                self.disconnect(key.fileobj, key.data)
+        if self.server is not None:
+            self.selector.unregister(self.server)
+            self.server.close()
+            os.remove(self.socket_path)
+        self.selector.close()
+        for stream in self.streams.values():
+            stream.state.close()
+        self.pool.wait()
+
+def load_collector(conf):
+    """Create collector from configuration with streams, values of defaults are used for missing keys of streams"""
+    if not isinstance(conf, dict) or not isinstance(conf.get('streams'), dict) or not conf['streams']:
+        raise ValueError('Configuration must contain streams')
+    defaults = conf.get('defaults') or {}
+    stagger = int(conf.get('stagger', 0))
+    streams = []
+    offsets = collections.Counter()
+    for name, stream_conf in sorted(conf['streams'].items()):
+        stream_conf = dict(defaults, **(stream_conf or {}))
+        for key in ('filename', 'backup', 'time'):
+            if not stream_conf.get(key):
+                raise ValueError('Missing {} of stream "{}"'.format(key, name))
+        try:
+            wanted_hour, wanted_minute = (int(item) for item in str(stream_conf['time']).split(':'))
+        except ValueError:
+            raise ValueError('Bad time "{}" of stream "{}"'.format(stream_conf['time'], name))
+        if stream_conf.get('compress') and stream_conf.get('stream_compress'):
+            raise ValueError('Stream "{}" cannot use both compress and stream_compress'.format(name))
+        if stream_conf.get('preallocate') and stream_conf.get('stream_compress'):
+            raise ValueError('Stream "{}" cannot use both preallocate and stream_compress'.format(name))
+        if not conf.get('socket') and not stream_conf.get('fifo'):
+            raise ValueError('Missing fifo of stream "{}" and socket of collector'.format(name))
+        state = State(
+            wanted_hour=wanted_hour,
+            wanted_minute=wanted_minute,
+            max_size=int(stream_conf['size']) * 1024 * 1024 if stream_conf.get('size') else None,
+            backup_mask=stream_conf['backup'],
+            filename=stream_conf['filename'],
+            compressor=stream_conf.get('compress'),
+            max_buffer=int(stream_conf.get('buffer_size', 0)) * 1024,
+            max_delay=int(stream_conf.get('flush_delay', 1000)) / 1000,
+            stream_compressor=stream_conf.get('stream_compress'),
+            preallocate=bool(stream_conf.get('preallocate', False)),
+            drop_cache=bool(stream_conf.get('drop_cache', False))
+        )
+        # streams rotated at the same time are spread by stagger seconds
+        offset = offsets[(wanted_hour, wanted_minute)] * stagger
+        offsets[(wanted_hour, wanted_minute)] += 1
+        streams.append(Stream(name, state, stream_conf.get('fifo'), offset))
+    return Collector(streams, conf.get('socket'), int(conf.get('compress_jobs', 1)))
@@ -13,3 +13,24 @@ def how_many_seconds_to_time(now, hour, minute):
 def local_tz_now():
     """Return current time with local timezone"""
     return datetime.datetime.now(datetime.timezone.utc).astimezone()
+
+class TimestampFormatter:
+    """Format unix time as local ISO timestamp, the part up to seconds and UTC offset is reused within one second"""
+    def __init__(self):
+        self.second = None
+        self.prefix = ''
+        self.offset = ''
+
+    def refresh(self, second):
+        """Format the cached parts for given whole second, the offset follows DST transitions"""
+        moment = datetime.datetime.fromtimestamp(second, datetime.timezone.utc).astimezone()
+        self.second = second
+        self.prefix = moment.strftime('%Y-%m-%dT%H:%M:%S.')
+        self.offset = moment.isoformat()[19:]
+
+    def format(self, timestamp):
+        """Return timestamp with microseconds and UTC offset"""
+        second, microsecond = divmod(int(timestamp * 1000000), 1000000)
+        if second != self.second:
+            self.refresh(second)
+        return '{}{:06d}{}'.format(self.prefix, microsecond, self.offset)